@@ -0,0 +1,140 @@
+"""Compare the lazy htmx request context with the middleware it replaced.
+
+Times building a request, plus its htmx details the way each approach does,
+for requests whose handler never reads `request.ctx.htmx` (static files, most
+API calls) and for handlers that read a few of its attributes:
+
+    python benchmarks/htmx_context.py --requests 100000
+
+The old approach is kept here as it was: an `on_request` middleware that
+attached an `HtmxDetails` to every request, with each attribute doing its own
+case-insensitive header lookups.
+"""
+import argparse
+import asyncio
+import json
+import time
+from functools import cached_property
+from importlib.util import module_from_spec, spec_from_file_location
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import unquote
+
+from sanic import Request, Sanic
+from sanic.compat import Header
+
+TEMPLATE = Path(__file__).parent.parent / "src" / "sanickit" / "template" / "default"
+MIDDLEWARE = TEMPLATE / "src" / "middleware" / "htmx.py"
+
+BROWSER_HEADERS = [
+    ("host", "localhost:8000"),
+    ("user-agent", "Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0"),
+    ("accept", "*/*"),
+    ("accept-language", "en-GB,en;q=0.5"),
+    ("accept-encoding", "gzip, deflate, br"),
+    ("referer", "http://localhost:8000/items"),
+    ("connection", "keep-alive"),
+    ("cookie", "session=0123456789abcdef"),
+]
+HTMX_HEADERS = [
+    ("hx-request", "true"),
+    ("hx-current-url", "http://localhost:8000/items"),
+    ("hx-target", "main"),
+    ("hx-trigger", "load-more"),
+]
+
+
+class OldHtmxDetails:
+    def __init__(self, request) -> None:
+        self.request = request
+
+    def _get_header_value(self, name: str) -> Optional[str]:
+        value = self.request.headers.get(name) or None
+        if value:
+            if self.request.headers.get(f"{name}-URI-AutoEncoded") == "true":
+                value = unquote(value)
+        return value
+
+    def __bool__(self) -> bool:
+        return self._get_header_value("HX-Request") == "true"
+
+    @cached_property
+    def current_url(self) -> Optional[str]:
+        return self._get_header_value("HX-Current-URL")
+
+    @cached_property
+    def target(self) -> Optional[str]:
+        return self._get_header_value("HX-Target")
+
+    @cached_property
+    def triggering_event(self) -> Any:
+        value = self._get_header_value("Triggering-Event")
+        if value is not None:
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                value = None
+        return value
+
+
+async def old_check_htmx(request):
+    request.ctx.htmx = OldHtmxDetails(request)
+
+
+def load_middleware():
+    """Import the template's middleware, which expects the app to exist already"""
+    Sanic("htmx_bench")
+    spec = spec_from_file_location("htmx_middleware", MIDDLEWARE)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read(htmx):
+    return bool(htmx) and (htmx.current_url, htmx.target, htmx.triggering_event)
+
+
+async def old_path(headers, touch):
+    request = Request(b"/items", Header(headers), "1.1", "GET", None, None)
+    await old_check_htmx(request)
+    if touch:
+        read(request.ctx.htmx)
+
+
+async def new_path(request_class, headers, touch):
+    request = request_class(b"/items", Header(headers), "1.1", "GET", None, None)
+    if touch:
+        read(request.ctx.htmx)
+
+
+async def time_path(path, requests, repeat=5):
+    """Nanoseconds per request, the best of `repeat` runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(requests):
+            await path()
+        best = min(best, time.perf_counter() - start)
+    return best / requests * 1e9
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100_000)
+    args = parser.parse_args()
+
+    request_class = load_middleware().HtmxRequest
+    print(f"{'':<34} {'old ns':>9} {'new ns':>9}")
+    for label, headers, touch in (
+        ("plain request, htmx not read", BROWSER_HEADERS, False),
+        ("htmx request, htmx not read", BROWSER_HEADERS + HTMX_HEADERS, False),
+        ("plain request, htmx read", BROWSER_HEADERS, True),
+        ("htmx request, htmx read", BROWSER_HEADERS + HTMX_HEADERS, True),
+    ):
+        old = await time_path(lambda: old_path(headers, touch), args.requests)
+        new = await time_path(lambda: new_path(request_class, headers, touch), args.requests)
+        print(f"{label:<34} {old:>9.0f} {new:>9.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""Compare `sanickit.page.parse_page` with the BeautifulSoup path it replaced.
+
+Generates a synthetic corpus of `+page.sanic` files and times how long each
+approach takes to split out the handler and produce the template text:
+
+    python benchmarks/page_parser.py --pages 3000
+
+Needs `beautifulsoup4`, which SanicKit itself no longer depends on.
+"""
+import argparse
+import random
+import time
+from textwrap import dedent
+
+from bs4 import BeautifulSoup as BS
+
+from sanickit.page import parse_page
+
+HANDLER = """\
+<handler id="int" route-name="item_{n}">
+from .lib.db import fetch
+item = await fetch(id)
+rows = [row for row in item.rows if row.visible]
+</handler>
+"""
+
+SECTION = """\
+<section class="card p-4 shadow">
+    <h2 class="text-xl">{{{{ item.title }}}} #{n}</h2>
+    <p>Some <em>inline</em> text, <a href="/items/{{{{ item.id }}}}">a link</a> and <code>code</code>.</p>
+    <pre>
+  preformatted   text
+    that must   survive
+    </pre>
+    <ul>
+    {{% for row in rows %}}
+        <li class="row">{{{{ row.name }}}}</li>
+    {{% endfor %}}
+    </ul>
+</section>
+"""
+
+
+def make_page(n, rng):
+    sections = "".join(SECTION.format(n=i) for i in range(rng.randint(5, 40)))
+    details = f"{{% block details %}}<p>{n}</p>{{% endblock %}}"
+    return HANDLER.format(n=n) + f"\n{{% block main %}}\n{sections}{details}\n{{% endblock %}}\n"
+
+
+def bs_path(source):
+    html = BS(source, "html.parser")
+    script = html.find("handler")
+    python = dedent(script.extract().text)
+    return python, dict(script.attrs), html.prettify()
+
+
+def parser_path(source):
+    page = parse_page(source)
+    return dedent(page.handler), page.attrs, page.template
+
+
+def bench(func, corpus):
+    start = time.perf_counter()
+    for source in corpus:
+        func(source)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_page(n, rng) for n in range(args.pages)]
+    size = sum(len(source) for source in corpus)
+
+    # Both should agree on the handler; only parse_page leaves the template untouched
+    for source in corpus[:50]:
+        (bs_code, bs_attrs, _), (code, attrs, template) = bs_path(source), parser_path(source)
+        assert bs_code == code and bs_attrs == attrs, source
+        assert template == source[source.index("</handler>") + len("</handler>") :], source
+
+    print(f"{args.pages} pages, {size / 1024 / 1024:.1f} MiB")
+    results = {"beautifulsoup": bench(bs_path, corpus), "parse_page": bench(parser_path, corpus)}
+    for name, elapsed in results.items():
+        print(f"{name:>14}: {elapsed:8.3f}s  {elapsed / args.pages * 1e6:10.1f}us/page")
+    print(f"{'speedup':>14}: {results['beautifulsoup'] / results['parse_page']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Generate synthetic SanicKit projects for the benchmarks.
+
+Projects start from the default template and add `routes` pages spread over
+sections and groups within them. Each section has a layout, as does every
+other group, so pages pick up layouts from different depths. Most pages sit
+under an `[id]` directory, have fragment blocks and import a helper from
+`lib`, every fourth of those also has a `+server.py`, and every fifth page is
+static.
+"""
+import shutil
+from pathlib import Path
+
+TEMPLATE = Path(__file__).parent.parent / "src" / "sanickit" / "template" / "default"
+
+PAGE = """\
+<handler id="int">
+from .lib.helpers{module} import summarise
+title = "Page {n}"
+items = summarise(id, {n})
+</handler>
+
+{{% block main %}}
+<section class="page-{n} p-4">
+    <h1 class="text-xl">{{{{ title }}}}</h1>
+    {{% block items %}}
+    <ul>
+    {{% for item in items %}}
+        <li class="item">{{{{ item }}}}</li>
+    {{% endfor %}}
+    </ul>
+    {{% endblock %}}
+    {{% block footer %}}<p>{{{{ id }}}}</p>{{% endblock %}}
+</section>
+{{% endblock %}}
+"""
+
+STATIC_PAGE = """\
+{{% block main %}}
+<article class="static-{n}">
+    <h1>Static page {n}</h1>
+    <p>Nothing to compute here.</p>
+</article>
+{{% endblock %}}
+"""
+
+SERVER = """\
+async def POST(request, id):
+    from sanic.response import json
+    return json({{"id": id, "page": {n}}})
+"""
+
+LAYOUT = """\
+{{% block body %}}
+<nav class="{n}"><a href="/">Home</a></nav>
+{{% block main %}}{{% endblock %}}
+{{% endblock %}}
+"""
+
+HELPERS = """\
+import json
+import statistics
+from decimal import Decimal
+
+
+def summarise(value, seed):
+    values = [Decimal(value) * i for i in range(1, 6)]
+    return [json.dumps(str(v)) for v in values] + [str(statistics.mean(values)), str(seed)]
+"""
+
+HELPER_MODULES = 10
+PAGES_PER_SECTION = 25
+PAGES_PER_GROUP = 5
+
+
+def page_dir(n: int) -> str:
+    """Where page `n` lives, relative to `src/routes`"""
+    group = f"section{n // PAGES_PER_SECTION}/group{n // PAGES_PER_GROUP}"
+    return f"{group}/static{n}" if n % 5 == 4 else f"{group}/page{n}/[id]"
+
+
+def page_url(n: int, id: int = 1) -> str:
+    return "/" + page_dir(n).replace("[id]", str(id))
+
+
+def make_project(root: Path, routes: int):
+    """Write a project with `routes` pages to `root`, which must not exist"""
+    shutil.copytree(TEMPLATE, root, ignore=shutil.ignore_patterns("*.jinja", ".gitkeep"))
+    (root / "pyproject.toml").write_text(f'[project]\nname = "bench{routes}"\n\n[sanickit]\nunpkgs = ["htmx.org"]\n')
+
+    lib = root / "src" / "lib"
+    for module in range(HELPER_MODULES):
+        (lib / f"helpers{module}.py").write_text(HELPERS)
+
+    routes_dir = root / "src" / "routes"
+    for n in range(routes):
+        page = routes_dir / page_dir(n)
+        page.mkdir(parents=True)
+        section, group = page.relative_to(routes_dir).parts[:2]
+        if not (layout := routes_dir / section / "+layout.html").exists():
+            layout.write_text(LAYOUT.format(n=section))
+        if (n // PAGES_PER_GROUP) % 2 and not (layout := routes_dir / section / group / "+layout.html").exists():
+            layout.write_text(LAYOUT.format(n=group))
+
+        if n % 5 == 4:
+            (page / "+page.sanic").write_text(STATIC_PAGE.format(n=n))
+            continue
+
+        (page / "+page.sanic").write_text(PAGE.format(n=n, module=n % HELPER_MODULES))
+        if n % 4 == 0:
+            (page / "+server.py").write_text(SERVER.format(n=n))
+    return root
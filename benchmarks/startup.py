@@ -0,0 +1,75 @@
+"""Measure how long a built app takes to start.
+
+Builds synthetic projects of increasing size and times `create_app` in a
+fresh interpreter, which is what every new Sanic worker pays:
+
+    python benchmarks/startup.py --routes 10 100 1000
+
+"lazy" is `create_app` as generated, which registers routes from the
+registry without importing any handler. "eager" also imports every handler
+module, which is roughly what startup cost before handlers were loaded on
+first request.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import chdir
+from pathlib import Path
+
+from project import make_project
+
+from sanickit.cli import _build
+
+PROBE = """\
+import sys, time
+sys.path.insert(0, ".")
+start = time.perf_counter()
+from app.server import create_app
+app = create_app(None)
+if {eager}:
+    from importlib import import_module
+    from app.registry import ROUTES
+    for module in {{route[3] for route in ROUTES}}:
+        import_module(module)
+print(time.perf_counter() - start)
+"""
+
+
+def time_startup(build, eager, repeat):
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE.format(eager=eager)],
+            cwd=build,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'routes':>8} {'lazy':>10} {'eager':>10}")
+    for routes in args.routes:
+        with tempfile.TemporaryDirectory() as tmp:
+            project = make_project(Path(tmp) / "project", routes)
+            with chdir(project):
+                _build(quiet=True)
+            build = project / "build"
+            # Warm the bytecode caches so both runs measure a normal restart
+            time_startup(build, eager=True, repeat=1)
+            lazy = time_startup(build, eager=False, repeat=args.repeat)
+            eager = time_startup(build, eager=True, repeat=args.repeat)
+        print(f"{routes:>8} {lazy * 1000:>8.0f}ms {eager * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
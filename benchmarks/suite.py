@@ -0,0 +1,186 @@
+"""Benchmark the build pipeline and the app it generates.
+
+For each project size this builds a synthetic project (see `project.py`) and
+measures:
+
+- cold build time and peak memory (a `--clean` build in a fresh process)
+- no-op build time (nothing has changed)
+- incremental build time (one page edited, as the file watcher would report it)
+- latency and throughput of a full page, a fragment and a static file, served
+  by the built `app.server:create_app` over ASGI in a fresh process
+
+Everything runs offline. Results are saved as JSON so runs can be compared:
+
+    python benchmarks/suite.py --routes 10 100 1000 --save benchmarks/results/main.json
+    python benchmarks/suite.py --routes 10 100 1000 --compare benchmarks/results/main.json
+
+With `--compare`, any measurement more than `--threshold` percent worse than
+the saved run is reported and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+from project import make_project, page_dir, page_url
+
+from sanickit.__about__ import __version__
+
+BUILD_PROBE = """\
+import json, resource, sys, time
+from sanickit.cli import _build
+changes = json.loads(sys.argv[1])
+start = time.perf_counter()
+_build(quiet=True, clean=changes == "clean", changes=set(changes) if isinstance(changes, list) else None)
+elapsed = time.perf_counter() - start
+# The largest of this process and the process pool workers, in KiB (bytes on macOS)
+peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+print(json.dumps({"seconds": elapsed, "peak_mib": peak / (2**20 if sys.platform == "darwin" else 2**10)}))
+"""
+
+SERVE_PROBE = """\
+import asyncio, json, sys, time
+sys.path.insert(0, ".")
+import httpx
+from app.server import create_app
+
+paths, requests = json.loads(sys.argv[1]), int(sys.argv[2])
+
+
+async def startup(app):
+    # Run the ASGI lifespan startup once, as a server would, rather than per request
+    messages, started = asyncio.Queue(), asyncio.Event()
+    await messages.put({"type": "lifespan.startup"})
+
+    async def send(message):
+        if message["type"].startswith("lifespan.startup"):
+            started.set()
+
+    task = asyncio.create_task(app({"type": "lifespan", "asgi": {"version": "3.0"}}, messages.get, send))
+    await started.wait()
+    return task
+
+
+async def main():
+    app = create_app(None)
+    lifespan = await startup(app)
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for kind, path in paths.items():
+            for _ in range(min(50, requests)):
+                response = await client.get(path, headers={"accept-encoding": "gzip"})
+                assert response.status_code == 200, (path, response.status_code)
+            latencies = []
+            for _ in range(requests):
+                began = time.perf_counter()
+                await client.get(path, headers={"accept-encoding": "gzip"})
+                latencies.append(time.perf_counter() - began)
+            latencies.sort()
+            results[kind] = {
+                "p50_ms": latencies[len(latencies) // 2] * 1000,
+                "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+                "rps": len(latencies) / sum(latencies),
+            }
+    lifespan.cancel()
+    print(json.dumps(results))
+
+
+asyncio.run(main())
+"""
+
+# Measurements where a bigger number is an improvement. Everything else is a time or size
+HIGHER_IS_BETTER = {"rps"}
+
+
+def run_probe(probe, *args, cwd):
+    """Run a probe in a fresh interpreter, returning what it printed as JSON"""
+    result = subprocess.run([sys.executable, "-c", probe, *args], cwd=cwd, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"Probe failed in {cwd}:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_size(routes, requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        project = make_project(Path(tmp) / "project", routes)
+        cold = run_probe(BUILD_PROBE, json.dumps("clean"), cwd=project)
+        # Builds alternate between two slots, so fill the second one before timing a build with nothing to do
+        run_probe(BUILD_PROBE, json.dumps(None), cwd=project)
+        noop = run_probe(BUILD_PROBE, json.dumps(None), cwd=project)
+
+        page = project / "src" / "routes" / page_dir(0) / "+page.sanic"
+        page.write_text(page.read_text().replace("<h1", '<h1 data-edited="1"'))
+        incremental = run_probe(BUILD_PROBE, json.dumps([str(page)]), cwd=project)
+
+        paths = {"page": page_url(0), "fragment": f"{page_url(0)}/items", "static": "/static/app.css"}
+        serving = run_probe(SERVE_PROBE, json.dumps(paths), str(requests), cwd=project / "build")
+
+    return {
+        "cold_build_s": cold["seconds"],
+        "cold_build_peak_mib": cold["peak_mib"],
+        "noop_build_s": noop["seconds"],
+        "incremental_build_s": incremental["seconds"],
+        **{f"{kind}_{name}": value for kind, results in serving.items() for name, value in results.items()},
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print each measurement against the baseline, returning those that got worse by more than `threshold`%"""
+    regressions = []
+    for routes, measurements in results.items():
+        for name, value in measurements.items():
+            if (before := baseline.get(routes, {}).get(name)) is None or before == 0:
+                continue
+            change = (value - before) / before * 100
+            worse = -change if name.rpartition("_")[2] in HIGHER_IS_BETTER else change
+            flag = "  REGRESSION" if worse > threshold else ""
+            print(f"{routes:>8} {name:<24} {before:>12.4g} {value:>12.4g} {change:>+8.1f}%{flag}")
+            if flag:
+                regressions.append((routes, name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, nargs="+", default=[10, 100, 1000], help="Project sizes, e.g. 10000")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per served path")
+    parser.add_argument("--save", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="Compare with results saved by an earlier run")
+    parser.add_argument("--threshold", type=float, default=10, help="Percent worse that counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for routes in args.routes:
+        print(f"Benchmarking {routes} routes...", file=sys.stderr)
+        results[str(routes)] = bench_size(routes, args.requests)
+
+    for routes, measurements in results.items():
+        print(f"\n{routes} routes")
+        for name, value in measurements.items():
+            print(f"  {name:<24} {value:>12.4g}")
+
+    if args.save:
+        args.save.parent.mkdir(exist_ok=True, parents=True)
+        run = {
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "results": results,
+        }
+        args.save.write_text(json.dumps(run, indent=1))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        print(f"\nCompared with {baseline['version']} ({baseline['date']})")
+        if regressions := compare(results, baseline["results"], args.threshold):
+            print(f"{len(regressions)} measurements regressed by more than {args.threshold:g}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import gzip
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Collection
+
+from jinja2 import FileSystemLoader
+
+from .manifest import hash_bytes
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is an optional extra
+    brotli = None
+
+# Written next to server.py, which reads it to serve and link the fingerprinted files
+STATIC_MANIFEST = "static.json"
+
+COMPRESSIBLE = {".css", ".js", ".mjs", ".json", ".map", ".svg", ".html", ".txt", ".xml", ".wasm"}
+# Below this the compressed variant rarely pays for the extra request header
+MIN_COMPRESS_SIZE = 256
+
+_STATIC_URL = re.compile(r"(?<=/static/)[^\"'\s()<>?#{}]+")
+
+
+def fingerprinted_name(path: str, digest: str) -> str:
+    """`css/app.css` becomes `css/app.<digest>.css`"""
+    parent, _, name = path.rpartition("/")
+    stem, dot, suffix = name.partition(".")
+    name = f"{stem}.{digest[:12]}{dot}{suffix}"
+    return f"{parent}/{name}" if parent else name
+
+
+def encoders():
+    """The `(suffix, compress)` pairs for each precompressed variant we can write"""
+    yield ".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield ".br", lambda data: brotli.compress(data, quality=11)
+
+
+def load_static_manifest(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {"files": {}, "outputs": []}
+
+
+def fingerprint_static(static: Path, manifest_path: Path, already_hashed: Collection[str] = ()) -> dict[str, str]:
+    """Give every static file a content hashed copy plus gzip and brotli variants
+
+    The originals are kept, so references that aren't rewritten still work.
+    Hashed names only ever hold one content, so files that are already there
+    are not written (or compressed) again. The files in `already_hashed`
+    have a hash in their name and are only compressed. Anything produced for
+    the previous build that is no longer needed is removed. Returns the
+    mapping of original to hashed paths, relative to `static`.
+    """
+    previous = set(load_static_manifest(manifest_path)["outputs"])
+    files = {}
+    outputs = []
+    for path in sorted(static.glob("**/*")):
+        relative = path.relative_to(static).as_posix()
+        if not path.is_file() or relative in previous or path.suffix in (".gz", ".br"):
+            continue
+        data = path.read_bytes()
+        if relative in already_hashed:
+            hashed = relative
+        else:
+            hashed = fingerprinted_name(relative, hash_bytes(data))
+            if not (static / hashed).exists():
+                (static / hashed).write_bytes(data)
+            outputs.append(hashed)
+        files[relative] = hashed
+
+        if path.suffix not in COMPRESSIBLE or len(data) < MIN_COMPRESS_SIZE:
+            continue
+        for suffix, compress in encoders():
+            variant = static / f"{hashed}{suffix}"
+            if not variant.exists():
+                if len(compressed := compress(data)) >= len(data):
+                    continue
+                variant.write_bytes(compressed)
+            outputs.append(f"{hashed}{suffix}")
+            if hashed != relative:
+                shutil.copyfile(variant, static / f"{relative}{suffix}")
+                outputs.append(f"{relative}{suffix}")
+
+    for stale in previous - set(outputs):
+        (static / stale).unlink(missing_ok=True)
+    manifest_path.write_text(json.dumps({"files": files, "outputs": outputs}, indent=1))
+    return files
+
+
+def clear_fingerprints(static: Path, manifest_path: Path):
+    """Remove everything `fingerprint_static` wrote"""
+    if not manifest_path.exists():
+        return
+    for output in load_static_manifest(manifest_path)["outputs"]:
+        (static / output).unlink(missing_ok=True)
+    manifest_path.unlink()
+
+
+def rewrite_static_urls(source: str, files: dict[str, str]) -> str:
+    """Point `/static/...` references at their fingerprinted copies"""
+    return _STATIC_URL.sub(lambda match: files.get(match.group(), match.group()), source)
+
+
+class FingerprintLoader(FileSystemLoader):
+    """Loads templates with their static URLs rewritten to the hashed files"""
+
+    def __init__(self, searchpath, files: dict[str, str]):
+        super().__init__(searchpath)
+        self.files = files
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return rewrite_static_urls(source, self.files), filename, uptodate
@@ -1,11 +1,13 @@
+import json
 import os
 import platform
 import shutil
 import stat
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import chdir
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
 from importlib.util import find_spec
 from multiprocessing import Process
 from pathlib import Path
@@ -14,15 +16,22 @@ from textwrap import dedent
 import click
 import httpx
 import tomlkit
-from bs4 import BeautifulSoup as BS
 from copier import run_copy
-from jinja2 import BaseLoader, Environment
+from jinja2 import BaseLoader, Environment, TemplateNotFound, TemplateSyntaxError, select_autoescape
 from rich import print
 from rich.markup import escape
+from rich.table import Table
 from tomlkit import loads
 from watchfiles import watch
 
-from .code import extract_api, extract_imports
+from .assets import STATIC_MANIFEST, FingerprintLoader, clear_fingerprints, fingerprint_static
+from .code import HandlerError, extract_api, extract_imports
+from .manifest import MANIFEST_NAME, Entry, Manifest, hash_bytes
+from .page import PageSyntaxError, find_blocks, parse_duration, parse_page
+from .profiling import Stopwatch, drain, print_profile, record, span, write_profile
+from .tailwind import CLASS_INDEX, TAILWIND_CONFIG, class_candidates, regenerate_css, tailwind_executable
+from .templates import TEMPLATE_DEPS, FlatteningLoader, MinifyingLoader, resolve_template_paths, template_variables
+from .vendor import UNPKG, VENDOR, VendorError, http_fetch, remove_vendored, vendor_urls
 
 
 @dataclass
@@ -31,6 +40,20 @@ class Config:
     unpkgs: list[str]
     stylesheets: list[str]
     tailwind: bool = False
+    vendor: bool = False
+    metrics: bool = False
+
+
+@dataclass
+class BuildReport:
+    """What a build changed in the app, for hot reloading the dev server"""
+
+    # Generated handler modules, e.g. `app.handlers.blog_slug`
+    modules: list[str] = field(default_factory=list)
+    # Template names, as the app's loader knows them
+    templates: list[str] = field(default_factory=list)
+    # Something the app only reads at startup changed (routes, middleware, library code)
+    restart: bool = False
 
 
 @click.group()
@@ -58,6 +81,8 @@ def get_config():
         unpkgs=list(sk_config.get("unpkgs", [])),
         stylesheets=list(sk_config.get("stylesheets", [])),
         tailwind=sk_config.get("tailwind", False),
+        vendor=sk_config.get("vendor", False),
+        metrics=sk_config.get("metrics", False),
     )
 
     return config
@@ -140,6 +165,7 @@ def download_tailwind():
 
 
 jinja_env = Environment(loader=BaseLoader())
+jinja_env.filters["repr"] = repr
 
 IMPORTS_TEMPLATE = jinja_env.from_string(
     """\
@@ -148,19 +174,47 @@ IMPORTS_TEMPLATE = jinja_env.from_string(
 {% endfor %}
 """
 )
-ENDPOINT_TEMPLATE = jinja_env.from_string(
+REGISTRY_TEMPLATE = jinja_env.from_string(
     """\
+# Generated by `sk build`. Lists everything `create_app` needs to set up the
+# app, so that it doesn't have to search for modules or import any handlers.
 
-@bp.{{method|lower}}("{{route}}", name="{{route_name}}")
-{%- if fragments %}
-@bp.{{method|lower}}("{{route}}{%- if route != '/' %}/{% endif %}<fragment:{{fragments}}>", name="{{route_name}}-fragments")
-{%- endif %}
-{{code}}
+MIDDLEWARE = (
+{%- for module in middleware %}
+    {{ module|repr }},
+{%- endfor %}
+)
+
+BLUEPRINTS = (
+{%- for module in blueprints %}
+    {{ module|repr }},
+{%- endfor %}
+)
 
+# (uri, method, route name, handler module, handler, (template, block) of a fragment,
+#  error format or "" for the app's fallback, None or the thread limit of a sync handler)
+ROUTES = (
+{%- for route in routes %}
+    {{ route|repr }},
+{%- endfor %}
+)
+
+# Record request metrics and serve them on /metrics (`metrics` in the config)
+METRICS = {{ metrics }}
 """
 )
 
 
+def route_module_name(src, route):
+    return (
+        str(route.relative_to(src / "routes").parent)
+        .replace(os.sep, "_")
+        .replace(".", "index")
+        .replace("[", "")
+        .replace("]", "")
+    )
+
+
 def handle_server(src, route, template_name):
     parameters = [x[1:-1] for x in route.parts if x.startswith("[") and x.endswith("]")]
     route_url = (
@@ -171,27 +225,15 @@ def handle_server(src, route, template_name):
         .replace("]", ">")
     )
 
-    name = (
-        str(route.relative_to(src / "routes").parent)
-        .replace(os.sep, "_")
-        .replace(".", "index")
-        .replace("[", "")
-        .replace("]", "")
-    )
-    imports, handlers = extract_api(route, name, template_name, parameters)
-    # Create the code
-    code = [
-        ENDPOINT_TEMPLATE.render(
-            route=route_url,
-            name=handler.name,
-            method=handler.method,
-            template=template_name,
-            code=handler.code,
-        )
+    name = route_module_name(src, route)
+    with span("transform handler", "step", route.as_posix()):
+        imports, handlers, helpers = extract_api(route, name, template_name, parameters)
+    routes = [
+        [route_url, handler.method, handler.name, handler.name, None, handler.error_format, handler.threads]
         for handler in handlers
     ]
 
-    return "\n".join(code), imports
+    return "\n\n\n".join([*helpers, *(handler.code for handler in handlers)]), imports, routes
 
 
 def find_nearest_layout(route):
@@ -202,30 +244,55 @@ def find_nearest_layout(route):
     return layout.relative_to("src")
 
 
+def template_source(src, name):
+    """The source of the generated template `name`, as far as reading which variables it uses goes"""
+    path = src / name
+    if path.suffix != ".html" or not path.is_file():
+        raise TemplateNotFound(name)
+    source, _ = resolve_template_paths(path.read_text(), name)
+    if path.name == "+layout.html":
+        source = """{% extends "index.html" %}\n\n""" + source
+    return source
+
+
+def used_variables(src, name):
+    """The variables a template, and the templates it extends and includes, read, or None if unknown"""
+    try:
+        return template_variables(template_source(src, name), lambda name: template_source(src, name))
+    except TemplateNotFound:
+        return None
+
+
 def handle_page(src, route, templates, template_name):
-    html = BS(route.read_text(), "html.parser")
+    with span("parse page", "step", route.as_posix()):
+        page = parse_page(route.read_text())
 
     layout = find_nearest_layout(route)
     layout_name = str(layout.as_posix()).replace("[", "").replace("]", "")
+    body, includes = resolve_template_paths(page.template, template_name)
+
+    with span("find context", "step", route.as_posix()):
+        context = used_variables(src, layout.as_posix())
+        own = template_variables(body, lambda name: template_source(src, name))
+        context = None if context is None or own is None else context | own
+    if context is None:
+        print(f"[yellow]Passing locals() to {escape(template_name)}: the templates it uses aren't all known")
 
     parameters = [x[1:-1] for x in route.parts if x.startswith("[") and x.endswith("]")]
-    name = route_name = (
-        str(route.relative_to(src / "routes").parent)
-        .replace(os.sep, "_")
-        .replace(".", "index")
-        .replace("[", "")
-        .replace("]", "")
-    )
-    if script := html.find("handler"):
-        route_name = script.attrs.get("route-name", name)
-        python = dedent(script.extract().text)
-        imports, python = extract_imports(python, name, template_name, parameters)
+    name = route_name = route_module_name(src, route)
+    if page.handler is not None:
+        route_name = page.attrs.get("route-name", name)
+        python = dedent(page.handler)
+        with span("transform handler", "step", route.as_posix()):
+            imports, python = extract_imports(
+                python, name, template_name, parameters, stream="stream" in page.attrs, context=context
+            )
 
         url_parts = []
         for part in route.relative_to(src / "routes").parent.parts:
             if part.startswith("[") and part.endswith("]"):
                 param = part[1:-1]
-                if param_type := script.attrs.get(param):
+                if param_type := page.attrs.get(param):
                     url_parts.append(f"<{param}:{param_type}>")
                 else:
                     url_parts.append(f"<{param}>")
@@ -243,156 +310,763 @@ def handle_page(src, route, templates, template_name):
             .replace("]", ">")
         )
 
-        imports, python = extract_imports("", name, template_name, parameters)
+        imports, python = extract_imports("", name, template_name, parameters, context=context)
+
+    decorators = []
+    if (cache := page.attrs.get("cache")) and "stream" in page.attrs:
+        print(f"[yellow]Ignoring the cache attribute of streamed page: [white]{escape(str(route))}")
+    elif cache:
+        vary = tuple(header.strip() for header in page.attrs.get("vary", "").split(",") if header.strip())
+        decorators.append(f"@cache_response({parse_duration(cache)!r}, vary={vary!r})")
+        imports.add("from app.server import cache_response")
 
-    fragments = jinja_env.from_string(html.prettify()).blocks.keys()
-    fragments_regex = f"({'|'.join(fragments)})"
+    with span("find blocks", "step", route.as_posix()):
+        blocks = find_blocks(page.template)
 
     # Write our template
-    (templates / template_name).write_text(f"""{{% extends "{layout_name}" %}}\n\n""" + html.prettify())
+    with span("write template", "step", route.as_posix()):
+        (templates / template_name).write_text(f"""{{% extends "{layout_name}" %}}\n\n""" + body)
+
+    routes = [[route_url, "GET", route_name, name, None, "html", None]]
+    for block in blocks:
+        fragment_url = f"{route_url}{'/' if route_url != '/' else ''}{block}"
+        routes.append([fragment_url, "GET", f"{route_name}-{block}", name, [template_name, block], "html", None])
+
+    return "\n".join([*decorators, python]), imports, routes, [layout_name, *includes]
+
+
+COPIED_TREES = ("lib", "blueprints", "middleware")
+
+# The package holding a generated module per route directory
+HANDLERS = "handlers"
+
+# Below this many changed routes, starting a process pool costs more than it saves
+PARALLEL_THRESHOLD = 16
+
+# How long (ms) the watcher waits for a burst of saves to settle before rebuilding
+WATCH_STEP = 50
+
+# Where `sk run` serves the app
+DEV_SERVER = "http://127.0.0.1:8000"
+
+# Environment for the dev server: rebuilds are hot reloaded through the app
+# itself, or by restarting the workers through the inspector, rather than by
+# Sanic's own reloader, which restarts on every change
+DEV_ENVIRONMENT = {"SANIC_HOT_RELOAD": "true", "SANIC_INSPECTOR": "true"}
+
+# Sits alongside `templates` in the build directory, see `create_app`
+COMPILED_TEMPLATES = "compiled_templates"
+
+# Builds alternate between two slots under build/slots/, and build/current
+# links to the last one to finish
+SLOTS = ("a", "b")
+CURRENT = "current"
+
+# Linked from build/ through build/current, so the server keeps running from build/
+PUBLISHED = ("app", "templates", COMPILED_TEMPLATES)
+
+
+def write_if_changed(path, text):
+    """Write `text` to `path`, leaving the file untouched if it already matches
+
+    Returns whether the file was written.
+    """
+    if path.exists() and path.read_text() == text:
+        return False
+    path.write_text(text)
+    return True
+
+
+def copy_if_changed(source, dest):
+    if dest.exists() and dest.read_bytes() == Path(source).read_bytes():
+        return False
+    shutil.copy(source, dest)
+    return True
+
+
+def route_deps(route, config_digest, contexts, includes=()):
+    """The non-content inputs that affect what a source file builds to
+
+    A page's handler passes its template the variables that the templates it
+    uses read, so it depends on those: its layout and the `includes` it was
+    last built with. Each template's variables are only looked up once, in
+    `contexts`.
+    """
+    match route.name:
+        case "+page.sanic":
+            layout = find_nearest_layout(route).as_posix()
+            digests = []
+            for name in (layout, *includes):
+                if (digest := contexts.get(name)) is None:
+                    names = used_variables(Path("src"), name)
+                    digest = contexts[name] = "*" if names is None else hash_bytes(" ".join(sorted(names)).encode())
+                digests.append(digest)
+            return {"layout": layout, "context": hash_bytes(" ".join(digests).encode())}
+        case "+head.html":
+            return {"config": config_digest}
+    return {}
+
+
+def build_route(src, build, templates, route, template_name, config):
+    """Process a single source file, returning a manifest entry for it"""
+    with span(route.name, "route", route.as_posix()):
+        try:
+            return _build_route(src, build, templates, route, template_name, config)
+        except (PageSyntaxError, HandlerError, TemplateSyntaxError, SyntaxError) as error:
+            print(f"[red bold]{escape(route.as_posix())}: {escape(str(error))}")
+            sys.exit(1)
+
+
+def _build_route(src, build, templates, route, template_name, config):
+    entry = Entry(hash="")
+    if route.suffix in (".sanic", ".html"):
+        with span("class candidates", "step", route.as_posix()):
+            entry.classes = class_candidates(route.read_text())
+    match route.name:
+        case "+page.sanic":
+            entry.code, imports, entry.routes, entry.includes = handle_page(
+                src, route, templates, template_name
+            )
+            entry.imports = sorted(imports)
+            entry.module = route_module_name(src, route)
+            entry.template = template_name
+            entry.outputs.append((templates / template_name).as_posix())
+        case "+server.py":
+            entry.code, imports, entry.routes = handle_server(src, route, template_name)
+            entry.imports = sorted(imports)
+            entry.module = route_module_name(src, route)
+        case "+layout.html":
+            template, entry.includes = resolve_template_paths(
+                """{% extends "index.html" %}\n\n""" + route.read_text(), template_name
+            )
+            (templates / template_name).write_text(template)
+            entry.outputs.append((templates / template_name).as_posix())
+        case "+head.html":
+            with span("render head", "step", route.as_posix()):
+                head = jinja_env.from_string(route.read_text()).render(**config)
+            (templates / template_name).write_text(head)
+            entry.outputs.append((templates / template_name).as_posix())
+        case _:
+            # Handle other files
+            relative = route.relative_to(src)
+            dests = []
+            match route.suffix:
+                case ".html":
+                    dests.append(templates / relative)
+                case ".py" if relative.parts[0] == "routes":
+                    module_path_parts = [
+                        part.replace("[", "").replace("]", "")
+                        for part in route.relative_to(src / "routes").parent.parts
+                    ]
+                    module_path = (build / "blueprints").joinpath(*module_path_parts)
+                    module_path.mkdir(exist_ok=True, parents=True)
+                    dests.append(module_path / route.name)
+            if relative.parts[0] in COPIED_TREES or relative == Path("server_setup.py"):
+                dests.append(build / relative)
+            for dest in dests:
+                dest.parent.mkdir(exist_ok=True, parents=True)
+                if templates in dest.parents:
+                    template, entry.includes = resolve_template_paths(route.read_text(), relative.as_posix())
+                    dest.write_text(template)
+                else:
+                    shutil.copy(route, dest)
+                entry.outputs.append(dest.as_posix())
+    return entry
 
-    return (
-        ENDPOINT_TEMPLATE.render(
-            route=route_url,
-            route_name=route_name,
-            method="get",
-            template=template_name,
-            fragments=fragments_regex,
-            code=python,
-        ),
-        imports,
+
+def timed_build_route(*args):
+    """`build_route` for a worker process, handing back the timings recorded there"""
+    # A forked worker starts with a copy of the parent's events
+    drain()
+    return build_route(*args), drain()
+
+
+def compile_routes(src, build, templates, dirty, config, jobs, quiet):
+    """Run `build_route` over the dirty sources, yielding `(route, entry)` pairs in order
+
+    Large batches are spread over a process pool. Each entry is given the
+    hash, stat and dependencies recorded for it during the scan.
+    """
+    for route, _ in dirty:
+        if not quiet:
+            print(f"[green]Processing: [yellow]{escape(str(route))}")
+
+    tasks = [
+        (src, build, templates, route, f"{route.with_suffix('').relative_to(src).as_posix()}.html", config)
+        for route, _ in dirty
+    ]
+    if jobs > 1 and len(tasks) >= PARALLEL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(timed_build_route, *zip(*tasks), chunksize=max(1, len(tasks) // (jobs * 4)))
+            entries = []
+            for entry, events in results:
+                entries.append(entry)
+                record(events)
+    else:
+        entries = [build_route(*task) for task in tasks]
+
+    for (route, scanned), entry in zip(dirty, entries):
+        entry.hash, entry.stat, entry.deps = scanned.hash, scanned.stat, scanned.deps
+        yield route, entry
+
+
+def drop_shadowed_fragments(routes):
+    """Leave out the fragment routes that have the URL of another route
+
+    A block's fragment is served below its page, so `routes/main/+page.sanic`
+    has the URL of the `main` block of the page above it. The page wins.
+    """
+    taken = {(uri.strip("/"), method) for uri, method, _, _, _, fragment, *_ in routes if fragment is None}
+    kept = []
+    for route in routes:
+        uri, method, _, _, _, fragment, *_ = route
+        if fragment is not None and (uri.strip("/"), method) in taken:
+            template, block = fragment
+            print(
+                f"[yellow]Not serving the [white]{escape(block)}[/white] block of {escape(template)} as a fragment:"
+                f" /{escape(uri.strip('/'))} is a page"
+            )
+            continue
+        kept.append(route)
+    return kept
+
+
+def top_level_modules(src, sources, package):
+    """The importable modules directly inside one of the copied packages"""
+    return [
+        f"app.{package}.{source.stem}"
+        for source in sources
+        if source.parent == src / package and source.suffix == ".py" and source.stem != "__init__"
+    ]
+
+
+def scope_changes(manifest, changes):
+    """Map a batch of changed paths onto the sources that need rescanning
+
+    Returns every source the build should contain and the subset of them to
+    look at again. A changed template rescans every page, since a page's
+    nearest layout, or the variables its layouts read, may have changed.
+    Sources that have gone are left out of both, so that their outputs get
+    pruned.
+    """
+    known = {Path(key) for key in manifest.entries}
+    rescan = set()
+    for path in changes:
+        path = Path(os.path.relpath(path))
+        if path.is_dir():
+            rescan.update(child for child in path.glob("**/*") if child.is_file())
+        else:
+            rescan.add(path)
+        if path.suffix == ".html":
+            rescan.update(key for key in known if key.name == "+page.sanic")
+        rescan.update(key for key in known if path in key.parents)
+
+    rescan = {path for path in rescan if path.is_file()}
+    return {path for path in known if path.exists()} | rescan, rescan
+
+
+def current_slot(build_root):
+    """The slot the server is running from, if there is one"""
+    current = build_root / CURRENT
+    if current.is_symlink():
+        return build_root / os.readlink(current)
+    if current.is_file():
+        # Published by copying, see `copy_slot`
+        return build_root / current.read_text().strip()
+    return None
+
+
+def staging_slot(build_root):
+    """The slot to build into: whichever one the server isn't using"""
+    current = current_slot(build_root)
+    return build_root / "slots" / (SLOTS[1] if current is not None and current.name == SLOTS[0] else SLOTS[0])
+
+
+def publish_slot(build_root, slot):
+    """Point build/current at a finished slot in a single rename
+
+    Where symlinks can't be made (e.g. on Windows without the privilege to),
+    the slot is copied into `build/` instead.
+    """
+    link = build_root / f".{CURRENT}.tmp"
+    link.unlink(missing_ok=True)
+    try:
+        link.symlink_to(slot.relative_to(build_root), target_is_directory=True)
+    except OSError:
+        copy_slot(build_root, slot)
+        return
+    os.replace(link, build_root / CURRENT)
+    for name in PUBLISHED:
+        if not (build_root / name).is_symlink():
+            # Copied there by an earlier build
+            shutil.rmtree(build_root / name, ignore_errors=True)
+            (build_root / name).symlink_to(Path(CURRENT) / name, target_is_directory=True)
+
+
+def copy_slot(build_root, slot):
+    """Publish a slot without symlinks, by copying what `build/` links to into place
+
+    Each directory is copied alongside the one it replaces and then renamed
+    over it, so the server only sees a mix of two builds between renames.
+    `build/current` becomes a file naming the slot.
+    """
+    for name in PUBLISHED:
+        target, staged, old = build_root / name, build_root / f".{name}.tmp", build_root / f".{name}.old"
+        shutil.rmtree(staged, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+        if (slot / name).is_dir():
+            shutil.copytree(slot / name, staged)
+        if target.is_symlink():
+            target.unlink()
+        elif target.exists():
+            target.rename(old)
+        if staged.exists():
+            staged.rename(target)
+        shutil.rmtree(old, ignore_errors=True)
+    marker = build_root / f".{CURRENT}.tmp"
+    marker.write_text(slot.relative_to(build_root).as_posix())
+    os.replace(marker, build_root / CURRENT)
+
+
+def published_report(previous, manifest, published, slot):
+    """What differs between the build the server is running and this one
+
+    `previous` is the manifest of the `published` slot. The changes noticed
+    while building are against the slot being built, which the server last
+    ran two builds ago, so they miss anything changed in the last build and
+    undone in this one.
+    """
+    report = BuildReport()
+    if not previous.entries:
+        report.restart = True
+        return report
+    for name in ("registry.py", "server.py", "metrics.py"):
+        old, new = published / "app" / name, slot / "app" / name
+        if not (old.exists() and new.exists() and old.read_bytes() == new.read_bytes()):
+            report.restart = True
+
+    for key in previous.entries.keys() | manifest.entries.keys():
+        before, after = previous.entries.get(key), manifest.entries.get(key)
+        if before is not None and after is not None and (before.hash, before.deps) == (after.hash, after.deps):
+            continue
+        for entry, root in ((before, published), (after, slot)):
+            if entry is None:
+                continue
+            if entry.module:
+                report.modules.append(f"app.{HANDLERS}.{entry.module}")
+            for output in map(Path, entry.outputs):
+                if root / "templates" in output.parents:
+                    report.templates.append(output.relative_to(root / "templates").as_posix())
+                elif output.suffix == ".py":
+                    report.restart = True
+    report.modules = list(dict.fromkeys(report.modules))
+    report.templates = list(dict.fromkeys(report.templates))
+    return report
+
+
+def compile_templates(build_root, static_files, flatten=(), minify=True):
+    """Precompile the generated templates into Python modules for `ModuleLoader`
+
+    The environment mirrors the one sanic-ext creates at runtime (async
+    rendering, autoescaping by extension) so the compiled code behaves exactly
+    like templates compiled on demand. References to static files are pointed
+    at their fingerprinted copies on the way in.
+
+    The page templates named in `flatten` are compiled with their layouts and
+    static includes inlined, see `flatten_template`. With `minify`, HTML
+    templates have their whitespace collapsed and comments dropped, see
+    `minify_html`.
+
+    Returns the flattened sources, keyed by template name, and the size in
+    bytes of each minified template before and after.
+    """
+    compiled = build_root / COMPILED_TEMPLATES
+    shutil.rmtree(compiled, ignore_errors=True)
+    flattening = FlatteningLoader(FingerprintLoader("templates", static_files), set(flatten))
+    loader = MinifyingLoader(flattening) if minify else flattening
+    with chdir(build_root):
+        env = Environment(loader=loader, autoescape=select_autoescape(), enable_async=True)
+        env.compile_templates(COMPILED_TEMPLATES, zip=None, ignore_errors=False)
+    return flattening.flattened, loader.sizes if minify else {}
+
+
+def print_minified(sizes):
+    """Show the bytes minifying saved for every template, largest savings first, and in total"""
+    before = sum(original for original, _ in sizes.values())
+    after = sum(minified for _, minified in sizes.values())
+    saved = sorted(sizes.items(), key=lambda item: item[1][1] - item[1][0])
+    table = Table("Template", "Bytes", "Minified", "Saved", title="Minified templates")
+    for name, (original, minified) in saved:
+        table.add_row(escape(name), str(original), str(minified), f"{1 - minified / original:.0%}" if original else "")
+    print(table)
+    print(
+        f"[green]Minified [yellow]{len(sizes)}[/yellow] templates from {before} to {after} bytes"
+        f" ([yellow]{1 - after / before if before else 0:.0%}[/yellow] smaller)"
     )
 
 
-def _build(restart=False, quiet=False):
+def update_tailwind(executable, manifest, index, css, quiet=False):
+    """Regenerate the Tailwind CSS if the class candidates in the templates have changed
+
+    Each manifest entry holds the candidates from its source, so only changed
+    templates are rescanned. Tailwind itself only reads the merged index and
+    is only run when that (or the Tailwind config) changes.
+    """
+    config = TAILWIND_CONFIG.read_bytes() if TAILWIND_CONFIG.exists() else b""
+    classes = sorted({token for entry in manifest.entries.values() for token in entry.classes})
+    candidates = "\n".join([f"/* {hash_bytes(config)} */", *classes]) + "\n"
+    if write_if_changed(index, candidates) or not css.exists():
+        if not regenerate_css(executable, index, css, quiet):
+            # Try again on the next build
+            index.unlink()
+
+
+def resolve_assets(config, static, fetcher=None):
+    """The script and stylesheet URLs for `+head.html`, vendored into `static` if asked for"""
+    scripts = [f"{UNPKG}{package}" for package in config["unpkgs"]]
+    stylesheets = config["stylesheets"]
+    if not config["vendor"]:
+        remove_vendored(static / VENDOR)
+        return {"scripts": scripts, "stylesheets": stylesheets}
+
+    try:
+        local = vendor_urls([*scripts, *stylesheets], static, fetcher or http_fetch)
+    except VendorError as error:
+        print(f"[red]{escape(str(error))}")
+        sys.exit(1)
+    return {"scripts": [local[url] for url in scripts], "stylesheets": [local[url] for url in stylesheets]}
+
+
+def _build(
+    clean=False,
+    quiet=False,
+    jobs=None,
+    changes=None,
+    production=False,
+    vendor=None,
+    fetcher=None,
+    flatten=False,
+    minify=True,
+):
+    """Build the app into `build/`, only reprocessing sources that have changed
+
+    Each build is written into whichever of the two slots in `build/slots/`
+    the server isn't running from, and then published by swapping the
+    `build/current` link over to it. `build/app` and `build/templates` link
+    through `build/current`, so the server only ever sees a finished build.
+
+    Each slot has a manifest recording what every source produced the last
+    time that slot was built, so unchanged routes reuse their generated code
+    and templates. Pass `clean=True` to throw it away and rebuild
+    everything. Changed routes are compiled across `jobs` worker processes
+    (defaulting to the core count).
+
+    `changes` is a set of paths reported by the file watcher. When given, only
+    those paths (and any pages whose layout they affect) are looked at, and
+    every other source is taken from the manifest as is. The paths the
+    published slot was built with are looked at too, as the slot being built
+    hasn't seen them.
+
+    `vendor` overrides the `vendor` setting in the config. When on, the
+    unpkg scripts and stylesheets are copied into `static/vendor/` (using
+    `fetcher` to download any that aren't cached) and linked from there.
+
+    Returns a `BuildReport` of the handler modules and templates that
+    differ from the build the server was running, for hot reloading the dev
+    server.
+
+    A `production` build also fingerprints and precompresses the static
+    files, and precompiles every template (with its static URLs rewritten)
+    so that workers load them as modules instead of compiling them on first
+    use. With `flatten`, each page is compiled together with its layouts and
+    static includes.
+    Unless `minify` is off, the compiled HTML templates are minified.
+    """
+    # Timings from an earlier build in this process (e.g. the watcher's) aren't wanted
+    drain()
+    stopwatch = Stopwatch()
+
+    jobs = jobs or os.cpu_count() or 1
     base = Path(".")
     src = base / "src"
 
     build_root = Path("build")
-
-    if not restart:
-        shutil.rmtree(build_root, ignore_errors=True)
-
-    build = build_root / "app"
+    if (build_root / "app").is_dir() and current_slot(build_root) is None:
+        # Built before there were slots
+        shutil.rmtree(build_root)
+
+    slot = staging_slot(build_root)
+    manifest = Manifest() if clean else Manifest.load(slot / MANIFEST_NAME)
+    # Outputs are about to change, so the manifest only describes the slot
+    # again once it is saved at the end. A build that stops before then
+    # leaves none, and the next build into the slot starts from scratch
+    (slot / MANIFEST_NAME).unlink(missing_ok=True)
+    if not manifest.entries:
+        shutil.rmtree(slot, ignore_errors=True)
+
+    published = current_slot(build_root)
+    previous = Manifest.load(published / MANIFEST_NAME) if published else Manifest()
+    recorded = [Path(os.path.relpath(path)).as_posix() for path in changes] if changes is not None else None
+    if changes is not None:
+        missed = previous.changes if published else None
+        changes = None if missed is None else {*changes, *missed}
+    stopwatch.lap("load manifest")
+
+    build = slot / "app"
     build.mkdir(exist_ok=True, parents=True)
 
     (build / "__init__.py").touch()
 
-    for name in ("blueprints", "middleware", "lib"):
+    for name in ("blueprints", "middleware", "lib", HANDLERS):
         (build / name).mkdir(exist_ok=True)
         (build / name / "__init__.py").touch()
 
     (build / "static").mkdir(exist_ok=True)
 
-    templates = build_root / "templates"
+    templates = slot / "templates"
     templates.mkdir(exist_ok=True)
 
     # Make the server
-    shutil.copy(find_spec("sanickit.template.server").origin, build / "server.py")
+    report = BuildReport()
+    report.restart = copy_if_changed(find_spec("sanickit.template.server").origin, build / "server.py")
+    report.restart |= copy_if_changed(find_spec("sanickit.template.metrics").origin, build / "metrics.py")
+
+    config = asdict(get_config())
+    if vendor is not None:
+        config["vendor"] = vendor
+    config.update(resolve_assets(config, build / "static", fetcher))
+    config_digest = hash_bytes(json.dumps(config, sort_keys=True).encode())
+    stopwatch.lap("prepare")
+
+    static = base / "static"
+    if changes is not None and manifest.entries:
+        known, rescan = scope_changes(manifest, changes)
+        sources = sorted(path for path in known if src in path.parents)
+        assets = sorted(path for path in known if static in path.parents)
+    else:
+        sources = [route for route in sorted(src.glob("**/*")) if route.is_file()]
+        assets = [asset for asset in sorted(static.glob("**/*")) if asset.is_file()]
+        rescan = None
+
+    seen = {path.as_posix() for path in (*sources, *assets)}
+    dirty = []
+    contexts = {}
+    for route in sources:
+        if rescan is not None and route not in rescan:
+            continue
+        if (path := route.parent.relative_to(src)) not in [Path("middleware")]:
+            (templates / path).mkdir(exist_ok=True, parents=True)
 
-    app_blueprint = """
-from sanic import Blueprint
-from sanic_ext import render
+        digest, file_stat = manifest.digest(route)
+        deps = route_deps(route, config_digest, contexts, manifest.includes(route))
+        if entry := manifest.fresh(route, digest, deps):
+            entry.stat = file_stat
+        else:
+            dirty.append((route, Entry(hash=digest, stat=file_stat, deps=deps)))
+    stopwatch.lap("scan sources")
+
+    for route, entry in compile_routes(src, build, templates, dirty, config, jobs, quiet):
+        if route.name == "+page.sanic":
+            # What the page includes now, rather than what it did when it was scanned
+            entry.deps = route_deps(route, config_digest, contexts, entry.includes)
+        manifest.record(route, entry)
+        for output in map(Path, entry.outputs):
+            if templates in output.parents:
+                report.templates.append(output.relative_to(templates).as_posix())
+            elif output.suffix == ".py":
+                report.restart = True
+    stopwatch.lap("compile routes")
+
+    # Group the handlers into a module per route directory
+    modules = {}
+    routes = []
+    for route in sources:
+        entry = manifest.entries[route.as_posix()]
+        if not entry.module:
+            continue
+        imports, code = modules.setdefault(entry.module, ([], []))
+        imports.extend(entry.imports)
+        code.append(entry.code)
+        module = f"app.{HANDLERS}.{entry.module}"
+        for uri, method, name, handler, fragment, error_format, threads in entry.routes:
+            routes.append(
+                (uri, method, name, module, handler, tuple(fragment) if fragment else None, error_format, threads)
+            )
+    routes = drop_shadowed_fragments(routes)
+
+    for asset in assets:
+        if rescan is not None and asset not in rescan:
+            continue
+        digest, file_stat = manifest.digest(asset)
+        if not (entry := manifest.fresh(asset, digest)):
+            dest = build / "static" / asset.relative_to(static)
+            dest.parent.mkdir(exist_ok=True, parents=True)
+            shutil.copy(asset, dest)
+            entry = Entry(hash=digest, outputs=[dest.as_posix()])
+            manifest.record(asset, entry)
+        entry.stat = file_stat
+    stopwatch.lap("copy static files")
+
+    for output in manifest.prune(seen):
+        Path(output).unlink(missing_ok=True)
+        report.restart |= output.endswith(".py")
+    stopwatch.lap("prune")
+
+    template_deps = {
+        output.relative_to(templates).as_posix(): entry.includes
+        for entry in manifest.entries.values()
+        if entry.includes
+        for output in map(Path, entry.outputs)
+        if templates in output.parents
+    }
+    write_if_changed(build / TEMPLATE_DEPS, json.dumps(dict(sorted(template_deps.items())), indent=1))
+
+    handlers = build / HANDLERS
+    for module, (imports, code) in modules.items():
+        if write_if_changed(
+            handlers / f"{module}.py",
+            IMPORTS_TEMPLATE.render(imports=dict.fromkeys(imports)) + "\n\n" + "\n\n\n".join(code) + "\n",
+        ):
+            report.modules.append(f"app.{HANDLERS}.{module}")
+    for module in handlers.glob("*.py"):
+        if module.stem not in modules and module.stem != "__init__":
+            module.unlink()
+
+    report.restart |= write_if_changed(
+        build / "registry.py",
+        REGISTRY_TEMPLATE.render(
+            middleware=top_level_modules(src, sources, "middleware"),
+            blueprints=top_level_modules(src, sources, "blueprints"),
+            routes=routes,
+            metrics=bool(config["metrics"]),
+        ),
+    )
+    stopwatch.lap("write handlers")
+
+    if (tailwind := tailwind_executable()) is not None:
+        update_tailwind(tailwind, manifest, slot / CLASS_INDEX, build / "static" / "tailwind.css", quiet)
+        stopwatch.lap("tailwind")
+
+    if production:
+        # Vendored files already have a hash in their name
+        vendored = [*config["scripts"], *config["stylesheets"]] if config["vendor"] else []
+        hashed = {url.removeprefix("/static/") for url in vendored}
+        static_files = fingerprint_static(build / "static", build / STATIC_MANIFEST, hashed)
+        stopwatch.lap("fingerprint static files")
+        pages = [entry.template for entry in manifest.entries.values() if entry.module and entry.template]
+        flattened, sizes = compile_templates(slot, static_files, pages if flatten else (), minify)
+        stopwatch.lap("compile templates")
+        if flatten and not quiet:
+            print(f"[green]Flattened [yellow]{len(flattened)}[/yellow] of {len(pages)} page templates")
+        if sizes and not quiet:
+            print_minified(sizes)
+    else:
+        # Stale compiled templates would shadow the ones we've just written
+        shutil.rmtree(slot / COMPILED_TEMPLATES, ignore_errors=True)
+        clear_fingerprints(build / "static", build / STATIC_MANIFEST)
 
+    if published is not None:
+        report = published_report(previous, manifest, published, slot)
+    manifest.changes = recorded
+    manifest.save(slot / MANIFEST_NAME)
+    stopwatch.lap("save manifest")
+    publish_slot(build_root, slot)
+    stopwatch.lap("publish")
+    return report
 
-bp = Blueprint("app_blueprint")
 
-"""
+@cli.command
+@click.option("--clean", is_flag=True, help="Ignore the build manifest and rebuild everything")
+@click.option(
+    "--jobs", "-j", type=click.IntRange(min=1), default=None, help="Worker processes to compile routes with"
+)
+@click.option("--production", is_flag=True, help="Fingerprint static files and precompile templates for deployment")
+@click.option(
+    "--flatten", is_flag=True, help="Compile each page with its layouts and includes inlined (implies --production)"
+)
+@click.option(
+    "--minify/--no-minify", default=True, help="Minify the precompiled HTML templates of a production build"
+)
+@click.option(
+    "--vendor/--no-vendor", default=None, help="Self-host the unpkg scripts and stylesheets instead of using CDNs"
+)
+@click.option("--profile", is_flag=True, help="Show how long each build phase and the slowest routes took")
+@click.option(
+    "--profile-output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Also write the timings to this file (implies --profile)",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice(["json", "chrome"]),
+    default="json",
+    help="A list of timings, or a Chrome trace for chrome://tracing or Perfetto",
+)
+def build(clean, jobs, production, flatten, minify, vendor, profile, profile_output, profile_format):
+    _build(clean=clean, jobs=jobs, production=production or flatten, vendor=vendor, flatten=flatten, minify=minify)
+    if profile or profile_output:
+        events = drain()
+        print_profile(events)
+        if profile_output:
+            write_profile(events, profile_output, profile_format)
+            print(f"[green]Wrote profile to [yellow]{escape(str(profile_output))}")
 
-    all_imports = []
-    for route in src.glob("**/*"):
-        if not quiet:
-            print(f"[green]Processing: [yellow]{escape(str(route))}")
-        template_name = f"{str(route.with_suffix('').relative_to(src).as_posix())}.html"
-        if (path := route.parent.relative_to(src)) not in [Path("middleware")]:
-            (templates / path).mkdir(exist_ok=True, parents=True)
-        # Create our template
-        match route.name:
-            case "+page.sanic":
-                code, imports = handle_page(src, route, templates, template_name)
-                app_blueprint += code
-                all_imports.extend(imports)
-            case "+server.py":
-                code, imports = handle_server(src, route, template_name)
-                app_blueprint += code
-                all_imports.extend(imports)
-            case "+layout.html":
-                html = BS(route.read_text(), "html.parser")
-                (templates / template_name).write_text("""{% extends "index.html" %}\n\n""" + html.prettify())
-            case "+head.html":
-                (templates / template_name).write_text(
-                    jinja_env.from_string(route.read_text()).render(**asdict(get_config()))
-                )
-            case _:
-                # Handle other files
-                match route.suffix:
-                    case ".html":
-                        shutil.copy(route, templates / route.parent.relative_to(src))
-                    case ".py" if route.relative_to(src).parts[0] == "routes":
-                        module_path_parts = [
-                            part.replace("[", "").replace("]", "")
-                            for part in route.relative_to(src / "routes").parent.parts
-                        ]
-                        module_path = (build / "blueprints").joinpath(*module_path_parts)
-                        module_path.mkdir(exist_ok=True, parents=True)
-                        shutil.copy(route, module_path / route.name)
-
-    (build / "blueprints" / "app.py").write_text(IMPORTS_TEMPLATE.render(imports=all_imports) + app_blueprint)
-
-    shutil.copy(src / "server_setup.py", build)
-
-    shutil.copytree(base / "static", build / "static", dirs_exist_ok=True)
-    shutil.copytree(src / "lib", build / "lib", dirs_exist_ok=True)
-    shutil.copytree(src / "blueprints", build / "blueprints", dirs_exist_ok=True)
-    shutil.copytree(src / "middleware", build / "middleware", dirs_exist_ok=True)
 
+def watched_paths():
+    return [path for path in (Path("./src"), Path("./static")) if path.exists()]
 
-@cli.command
-def build():
-    _build()
+
+def reload_server(report):
+    """Bring the dev server up to date with a build
+
+    Changed handlers and templates are swapped in place through the app's
+    hot reload endpoint. Anything else the app only reads at startup needs
+    the workers restarting, which the Sanic inspector does.
+    """
+    from .template.server import HOT_RELOAD_PATH
+
+    if report.restart:
+        subprocess.run([Path(sys.executable).parent / "sanic", "inspect", "reload"], capture_output=True)
+    elif report.modules or report.templates:
+        try:
+            httpx.post(f"{DEV_SERVER}{HOT_RELOAD_PATH}", json=asdict(report), timeout=5)
+        except httpx.HTTPError as error:
+            print(f"[yellow]Couldn't hot reload the server: {escape(str(error))}")
 
 
 def watch_files():
     try:
-        for _ in watch(Path("./src")):
-            _build(restart=True)
+        for changes in watch(*watched_paths(), step=WATCH_STEP):
+            try:
+                report = _build(changes={path for _, path in changes})
+            except SystemExit:
+                # The build has said what is wrong, and the server still has the last good one.
+                # Keep watching for the fix
+                continue
+            reload_server(report)
     except KeyboardInterrupt:
         pass
 
 
 @cli.command
 def run():
-    _build()
-
+    # The build regenerates the Tailwind CSS itself whenever the templates change
     download_tailwind()
+    _build()
 
-    tailwind: str
-    if Path("./.sanickit/tailwindcss.exe").exists():
-        tailwind = "./.sanickit/tailwindcss.exe"
-    else:
-        tailwind = "./.sanickit/tailwindcss"
-    tailwind_process = subprocess.Popen(
-        [
-            tailwind,
-            "--watch",
-            "./src",
-            "--output",
-            "./build/app/static/tailwind.css",
-            "--config",
-            "./.sanickit/tailwind.config.js",
-        ]
-    )
     file_watcher = Process(target=watch_files)
     file_watcher.start()
     try:
         with chdir(Path("build")):
             subprocess.run(
-                [Path(sys.executable).parent / "sanic", "app.server:create_app", "--debug", "--dev"], check=True
+                [Path(sys.executable).parent / "sanic", "app.server:create_app", "--debug"],
+                check=True,
+                env={**os.environ, **DEV_ENVIRONMENT},
             )
     except KeyboardInterrupt:
         pass
     file_watcher.close()
-    tailwind_process.terminate()
 
 
 @cli.command
@@ -1,5 +1,4 @@
 import ast
-import sys
 from dataclasses import dataclass
 from textwrap import dedent
 
@@ -7,11 +6,57 @@ from rich import print
 from rich.markup import escape
 
 
+# The functions of a `+server.py` that handle requests, by their upper-cased name
+HTTP_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS")
+
+# The error format a handler's responses imply, by the response function or
+# content type it returns, as in `sanic.errorpages.RESPONSE_MAPPING`
+RESPONSE_FORMATS = {
+    "json": "json",
+    "text": "text",
+    "html": "html",
+    "JSONResponse": "json",
+    "text/plain": "text",
+    "text/html": "html",
+    "application/json": "json",
+}
+
+
 @dataclass
 class APIHandler:
     name: str
     method: str
     code: str
+    # For a sync handler, how many requests may run it at once (0 for the app's
+    # default). None for an async handler
+    threads: int | None = None
+    # How Sanic should render the handler's errors, or "" to let it decide
+    error_format: str = ""
+
+
+def error_format(node):
+    """
+    The error format of a handler that only returns one type of response, or
+    "". This is how Sanic guesses it when a route is added, which it can't do
+    for the route handler that imports the real one
+    """
+    formats = set()
+    for statement in ast.walk(node):
+        match statement:
+            case ast.Return(value=ast.Call(func=ast.Name(id=function), keywords=keywords)):
+                content_types = [
+                    keyword.value.value
+                    for keyword in keywords
+                    if keyword.arg == "content_type" and isinstance(keyword.value, ast.Constant)
+                ]
+                formats.update(
+                    RESPONSE_FORMATS[check] for check in [function, *content_types] if check in RESPONSE_FORMATS
+                )
+    return formats.pop() if len(formats) == 1 else ""
+
+
+class HandlerError(ValueError):
+    """Raised when a handler file can't be turned into route handlers"""
 
 
 class Extractor(ast.NodeTransformer):
@@ -35,29 +80,84 @@ class Extractor(ast.NodeTransformer):
         match node:
             case ast.ImportFrom(module="lib", names=names, level=1):
                 node = ast.ImportFrom(module="app.lib", names=names, level=0)
+            case ast.ImportFrom(module=module, names=names, level=1) if module.startswith("lib."):
+                node = ast.ImportFrom(module=f"app.{module}", names=names, level=0)
             case ast.ImportFrom(module=module, names=names, level=1):
-                node = ast.ImportFrom(module=f"{self.name.replace('_', '.')}.{module}", names=names, level=1)
+                node = ast.ImportFrom(
+                    module=f"app.blueprints.{self.name.replace('_', '.')}.{module}", names=names, level=0
+                )
             case _:
                 ...
         self._extracted_imports.add(ast.unparse(node))
 
     def visit_FunctionDef(self, node):
-        print(f"[red bold]Non-async handler detected: {node.name}")
-        sys.exit()
+        msg = f"Non-async handler detected: {node.name}"
+        raise HandlerError(msg)
 
 
 class APIExtract(Extractor):
-    """Makes our bare files into functions"""
+    """Makes our bare files into functions
+
+    Each top level function named after an HTTP method (in any case) is a
+    handler for it. Plain `def` handlers are run on a thread pool by the app,
+    at most `n` at once when decorated with `@concurrency(n)`. Other top level
+    functions are kept as they are, as helpers for the handlers.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.handlers = []
+        self.helpers = []
+
+    def visit_Module(self, node):
+        functions = [
+            statement for statement in node.body if isinstance(statement, (ast.AsyncFunctionDef, ast.FunctionDef))
+        ]
+        methods = [function.name for function in functions if function.name.upper() in HTTP_METHODS]
+        handler_names = {self.name, *(f"{self.name}_{method}" for method in methods)}
+        for function in functions:
+            if function.name.upper() in HTTP_METHODS:
+                if [method.upper() for method in methods].count(function.name.upper()) > 1:
+                    self.fail(f"More than one handler for {function.name.upper()}: {function.name}")
+            elif function.name in handler_names:
+                self.fail(f"Helper function has the name of a generated handler: {function.name}")
+            elif self.concurrency(function):
+                self.fail(f"@concurrency on a function that isn't named after an HTTP method: {function.name}")
+
+        for statement in node.body:
+            if statement in functions and statement.name.upper() in HTTP_METHODS:
+                self.add_handler(statement)
+            elif statement in functions:
+                self.generic_visit(statement)
+                self.helpers.append(ast.unparse(statement))
+            else:
+                self.visit(statement)
+        return node
+
+    def fail(self, message):
+        raise HandlerError(message)
+
+    def visit_FunctionDef(self, node):
+        # A helper inside a handler
+        return self.generic_visit(node)
+
+    def concurrency(self, node):
+        """The `n` of a handler's `@concurrency(n)`, or 0 if it has none"""
+        for decorator in node.decorator_list:
+            match decorator:
+                case ast.Call(func=ast.Name(id="concurrency"), args=[ast.Constant(value=int(limit))], keywords=[]):
+                    if limit < 1:
+                        self.fail(f"@concurrency needs at least 1 thread: {node.name}")
+                    return limit
+        return 0
 
-    def visit_AsyncFunctionDef(self, node):
+    def add_handler(self, node):
         super().generic_visit(node)
         name = f"{self.name}_{node.name}"
+        threads = None if isinstance(node, ast.AsyncFunctionDef) else self.concurrency(node)
+        handler_error_format = error_format(node)
 
-        wrapper = ast.AsyncFunctionDef(
+        wrapper = (ast.AsyncFunctionDef if threads is None else ast.FunctionDef)(
             name=name,
             decorator_list=[],
             args=ast.arguments(
@@ -72,27 +172,188 @@ class APIExtract(Extractor):
         # wrapper.body.extend(self.new_return.body)
         wrapper.lineno = 1
         node.body = [wrapper]
-        self.handlers.append(APIHandler(name=name, method=node.name.upper(), code=ast.unparse(wrapper)))
+        self.handlers.append(
+            APIHandler(
+                name=name,
+                method=node.name.upper(),
+                code=ast.unparse(wrapper),
+                threads=threads,
+                error_format=handler_error_format,
+            )
+        )
         return node
 
 
+# `ast.TryStar` is new in Python 3.11
+_TRY = tuple(getattr(ast, name) for name in ("Try", "TryStar") if hasattr(ast, name))
+
+
+class LocalNames(ast.NodeVisitor):
+    """Collects the names a handler body binds, leaving out nested scopes"""
+
+    def __init__(self):
+        self.names = set()
+        # Declared `global` or `nonlocal`, so never in `locals()`
+        self.outer = set()
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Store):
+            self.names.add(node.id)
+
+    def visit_FunctionDef(self, node):
+        self.names.add(node.name)
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        pass
+
+    def visit_ListComp(self, node):
+        # Only `:=` binds a name outside the comprehension
+        self.names.update(_walrus(node))
+
+    visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node):
+        if node.name:
+            self.names.add(node.name)
+        self.generic_visit(node)
+
+    visit_MatchStar = visit_MatchAs
+
+    def visit_MatchMapping(self, node):
+        if node.rest:
+            self.names.add(node.rest)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        self.outer.update(node.names)
+
+    visit_Nonlocal = visit_Global
+
+
+def _bound(node) -> set:
+    """The names a node binds when it runs to completion"""
+    visitor = LocalNames()
+    visitor.visit(node)
+    return visitor.names
+
+
+def _walrus(expression) -> set:
+    """The names bound by `:=` in an expression that always runs, e.g. the test of an `if`"""
+    return {node.target.id for node in ast.walk(expression) if isinstance(node, ast.NamedExpr)}
+
+
+def _falls_through(body) -> bool:
+    """Whether running `body` can carry on to the statement after it"""
+    return not body or not isinstance(body[-1], (ast.Return, ast.Raise, ast.Break, ast.Continue))
+
+
+def bound_at_returns(body, bound, returns) -> set:
+    """Record in `returns` the names certainly bound at each `return` in `body`
+
+    `returns` maps the id of each `ast.Return` to its names. Returns the names
+    certainly bound once `body` has run to the end. A name bound on every
+    branch of an `if` that carries on past it counts after the `if`. Anything
+    else that might not have run (a loop body, a `try`) only counts inside
+    itself, so this errs towards too few names.
+    """
+    bound = set(bound)
+    for statement in body:
+        match statement:
+            case ast.Return():
+                returns[id(statement)] = bound
+            case ast.If(test=test):
+                inner = bound | _walrus(test)
+                ends = []
+                for branch in (statement.body, statement.orelse):
+                    end = bound_at_returns(branch, inner, returns)
+                    # Only the branches that carry on past the `if` say what is bound after it
+                    if _falls_through(branch):
+                        ends.append(end)
+                bound = set.intersection(*ends) if ends else inner
+            case ast.While(test=test):
+                inner = bound | _walrus(test)
+                bound_at_returns(statement.body, inner, returns)
+                bound_at_returns(statement.orelse, inner, returns)
+                bound = inner
+            case ast.For(target=target) | ast.AsyncFor(target=target):
+                bound_at_returns(statement.body, bound | _bound(target) | _walrus(statement.iter), returns)
+                bound_at_returns(statement.orelse, bound | _walrus(statement.iter), returns)
+                bound = bound | _walrus(statement.iter)
+            case ast.With(items=items) | ast.AsyncWith(items=items):
+                inner = set(bound)
+                for item in items:
+                    inner |= _walrus(item.context_expr)
+                    if item.optional_vars is not None:
+                        inner |= _bound(item.optional_vars)
+                bound = bound_at_returns(statement.body, inner, returns)
+            case _ if isinstance(statement, _TRY):
+                done = bound_at_returns(statement.body, bound, returns)
+                for handler in statement.handlers:
+                    bound_at_returns(handler.body, bound | ({handler.name} if handler.name else set()), returns)
+                bound_at_returns(statement.orelse, done, returns)
+                bound_at_returns(statement.finalbody, bound, returns)
+            case ast.Match(subject=subject):
+                bound = bound | _walrus(subject)
+                for case in statement.cases:
+                    bound_at_returns(case.body, bound | _bound(case.pattern), returns)
+            case ast.FunctionDef() | ast.AsyncFunctionDef() | ast.ClassDef():
+                bound = bound | {statement.name}
+            case ast.Assign() | ast.AnnAssign(value=ast.AST()) | ast.AugAssign():
+                targets = statement.targets if isinstance(statement, ast.Assign) else [statement.target]
+                for target in targets:
+                    bound = bound | _bound(target)
+            case ast.Delete(targets=targets):
+                bound = bound - {target.id for target in targets if isinstance(target, ast.Name)}
+    return bound
+
+
 class FunctionAdder(Extractor):
     """Makes our bare files into functions"""
 
-    def __init__(self, name, template_name, parameters, *args, **kwargs):
+    def __init__(self, name, template_name, parameters, *args, stream=False, context=None, **kwargs):
         super().__init__(name, template_name, parameters)
-        self.new_return = ast.parse(
-            dedent(
-                f"""\
-                    if fragment:
-                        return html(await render_block_async(request.app.ext.environment, "{template_name}", fragment, **locals()))
-                    else:
-                        return await render("{template_name}", context=locals())"""
-            )
-        )
         self.template_name = template_name
+        self.stream = stream
+        # The variables the template reads, or None to pass it `locals()`
+        self.context = context
+        self.returns = {}
+        self.arguments = {"request", *parameters, "fragment", "TEMPLATE"}
+        self.locals = set()
         self._extracted_imports.add("from sanic.response import html")
-        self._extracted_imports.add("from jinja2_fragments import render_block_async")
+        if stream:
+            self._extracted_imports.add("from app.server import stream_template")
+        else:
+            self._extracted_imports.add("from sanic_ext import render")
+
+    def context_for(self, bound):
+        """The context to render with, given the names certainly bound where it is rendered
+
+        Only the local variables the template reads are passed. If one of them
+        might not have been assigned yet, `locals()` is passed instead.
+        """
+        if self.context is None:
+            return "locals()"
+        names = sorted(self.context & (self.locals | self.arguments))
+        if unbound := [name for name in names if name not in bound and name not in self.arguments]:
+            print(
+                f"[yellow]Passing locals() to {escape(self.template_name)}:"
+                f" {escape(', '.join(unbound))} might not be assigned when it is rendered"
+            )
+            return "locals()"
+        return "{" + ", ".join(f'"{name}": {name}' for name in names) + "}"
+
+    def render_template(self, context):
+        """The expression that renders the whole page"""
+        if self.stream:
+            return f"""await stream_template(request, "{self.template_name}", {context})"""
+        return f"""await render("{self.template_name}", context={context})"""
 
     def visit_Return(self, node):
         match node:
@@ -103,16 +364,33 @@ class FunctionAdder(Extractor):
                     keywords=[],
                 )
             ):
-                return ast.parse(
-                    f"""return text(await render_block_async(request.app.ext.environment, "{self.template_name}", "{fragment}", **locals()))"""
-                )
+                self._extracted_imports.add("from app.server import Fragment")
+                context = self.context_for(self.returns.get(id(node), set()))
+                block = f"""Fragment.get("{self.template_name}", "{fragment}")"""
+                return ast.parse(f"""return html(await {block}.render(request.app.ext.environment, {context}))""")
             case ast.Return(value=ast.Call(func=ast.Name(id="template"), args=[], keywords=[])):
-                return ast.parse(f"""return await render("{self.template_name}", context=locals())""")
+                context = self.context_for(self.returns.get(id(node), set()))
+                return ast.parse(f"""return {self.render_template(context)}""")
             case _:
                 return node
 
     def visit_Module(self, node):
+        local_names = LocalNames()
+        local_names.visit(node)
+        self.locals = local_names.names - local_names.outer
+        self.arguments -= local_names.outer
+        end = bound_at_returns(node.body, set(), self.returns)
         super().generic_visit(node)
+        context = self.context_for(end)
+        new_return = ast.parse(
+            dedent(
+                f"""\
+                    if fragment:
+                        return html(await fragment.render(request.app.ext.environment, {context}))
+                    else:
+                        return {self.render_template(context)}"""
+            )
+        )
 
         wrapper = ast.AsyncFunctionDef(
             name=self.name,
@@ -126,15 +404,15 @@ class FunctionAdder(Extractor):
             ),
         )
         wrapper.body = node.body
-        wrapper.body.extend(self.new_return.body)
+        wrapper.body.extend(new_return.body)
         wrapper.lineno = 1
         node.body = [wrapper]
         return node
 
 
-def extract_imports(code, name, template_name, parameters):
+def extract_imports(code, name, template_name, parameters, stream=False, context=None):
     tree = ast.parse(code)
-    transformer = FunctionAdder(name, template_name, parameters)
+    transformer = FunctionAdder(name, template_name, parameters, stream=stream, context=context)
     new_function_tree = transformer.visit(tree)
     return transformer.extracted_imports, ast.unparse(new_function_tree)
 
@@ -143,4 +421,4 @@ def extract_api(source_file, name, template_name, parameters):
     tree = ast.parse(source_file.read_text())
     transformer = APIExtract(name, template_name, parameters)
     transformer.visit(tree)
-    return transformer.extracted_imports, transformer.handlers
+    return transformer.extracted_imports, transformer.handlers, transformer.helpers
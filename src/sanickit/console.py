@@ -1,6 +1,5 @@
 import asyncio
 import os
-import subprocess
 import sys
 from contextlib import chdir, contextmanager, redirect_stderr, redirect_stdout
 from pathlib import Path
@@ -20,7 +19,7 @@ from textual.widgets._directory_tree import DirEntry
 from watchfiles import awatch
 
 from .cli import _build as build_app
-from .cli import download_tailwind
+from .cli import DEV_ENVIRONMENT, WATCH_STEP, download_tailwind, reload_server, watched_paths
 
 SANIC_EXE = Path(sys.executable).parent / "sanic"
 
@@ -132,7 +131,6 @@ class Server(Widget):
     def __init__(self):
         super().__init__()
         self.server_process = None
-        self.tailwind_process = None
 
     def compose(self):
         with Horizontal():
@@ -143,7 +141,7 @@ class Server(Widget):
 
     async def run_inspector(self, command):
         process = await asyncio.subprocess.create_subprocess_exec(
-            *[SANIC_EXE, "inspect", "reload"],
+            *[SANIC_EXE, "inspect", command],
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
@@ -156,7 +154,6 @@ class Server(Widget):
                 button.disabled = True
                 self.query_one("#reload").disabled = False
                 self.query_one("#stop").disabled = False
-                self.start_tailwind()
                 self.watch_files()
                 self.start_server()
             case "reload":
@@ -172,39 +169,24 @@ class Server(Widget):
 
     @work(exclusive=True, group="watcher")
     async def watch_files(self):
-        async for _ in awatch(Path("./src")):
-            build_app(restart=True, quiet=True)
-
-    @work(exclusive=True, group="tailwind")
-    def start_tailwind(self):
-        download_tailwind()
-
-        self.tailwind_process = process = subprocess.Popen(
-            [
-                "./.sanickit/tailwindcss",
-                "--poll",
-                "--watch",
-                "./src",
-                "--output",
-                "./build/app/static/tailwind.css",
-                "--config",
-                "./.sanickit/tailwind.config.js",
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-
-        process.wait()
+        async for changes in awatch(*watched_paths(), step=WATCH_STEP):
+            try:
+                report = build_app(quiet=True, changes={path for _, path in changes})
+            except SystemExit:
+                # The server still has the last good build. Keep watching for the fix
+                self.query_one(TextLog).write("Build failed, serving the last good build")
+                continue
+            await asyncio.to_thread(reload_server, report)
 
     @work(exclusive=True, group="server")
     async def start_server(self):
         text_log = self.query_one(TextLog)
 
+        # Builds regenerate the Tailwind CSS, so there's no Tailwind watcher to start
+        download_tailwind()
         build_app()
 
-        my_env = os.environ.copy()
-        my_env["SANIC_INSPECTOR"] = "True"
+        my_env = {**os.environ, **DEV_ENVIRONMENT}
 
         with chdir(Path("build")):
             self.server_process = process = await asyncio.subprocess.create_subprocess_exec(
@@ -212,7 +194,6 @@ class Server(Widget):
                     SANIC_EXE,
                     "app.server:create_app",
                     "--debug",
-                    "--dev",
                     "--no-motd",
                     "--coffee",
                 ],
@@ -232,8 +213,6 @@ class Server(Widget):
     def on_unmount(self, _):
         if self.server_process:
             self.server_process.terminate()
-        if self.tailwind_process:
-            self.tailwind_process.terminate()
 
 
 class Routes(Widget):
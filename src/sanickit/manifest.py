@@ -0,0 +1,105 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from .__about__ import __version__
+
+# Kept in the build slot the manifest describes
+MANIFEST_NAME = "manifest.json"
+
+# Bump whenever the code or templates generated for a source change shape,
+# so that manifests written by an older build are discarded
+BUILD_FORMAT = 11
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    return hash_bytes(Path(path).read_bytes())
+
+
+@dataclass
+class Entry:
+    """The build record for a single source file"""
+
+    hash: str
+    stat: list[int] = field(default_factory=list)
+    deps: dict[str, str] = field(default_factory=dict)
+    outputs: list[str] = field(default_factory=list)
+    code: str = ""
+    imports: list[str] = field(default_factory=list)
+    module: str = ""
+    routes: list[list] = field(default_factory=list)
+    template: str = ""
+    classes: list[str] = field(default_factory=list)
+    # Templates that the generated template includes, imports or extends
+    includes: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Manifest:
+    """Records what each source file produced on the last build.
+
+    Sources are keyed by their path relative to the project root. An entry is
+    reused when the source's content hash, its dependencies (e.g. the nearest
+    layout of a page) and its outputs are all unchanged.
+    """
+
+    version: str = f"{__version__}+{BUILD_FORMAT}"
+    entries: dict[str, Entry] = field(default_factory=dict)
+    # The paths the watcher reported for this build, or None if every source was looked at
+    changes: list[str] | None = None
+
+    @classmethod
+    def load(cls, path: Path) -> "Manifest":
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return cls()
+        if data.get("version") != cls.version:
+            return cls()
+        return cls(
+            entries={key: Entry(**entry) for key, entry in data.get("entries", {}).items()},
+            changes=data.get("changes"),
+        )
+
+    def save(self, path: Path):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        data = asdict(self)
+        data["entries"] = dict(sorted(data["entries"].items()))
+        path.write_text(json.dumps(data, indent=1))
+
+    def digest(self, source: Path) -> tuple[str, list[int]]:
+        """Hash a source file, skipping the read when its mtime and size are unchanged"""
+        st = source.stat()
+        stat = [st.st_mtime_ns, st.st_size]
+        if (entry := self.entries.get(source.as_posix())) and entry.stat == stat:
+            return entry.hash, stat
+        return hash_file(source), stat
+
+    def fresh(self, source: Path, digest: str, deps: dict[str, str] | None = None) -> Entry | None:
+        """Return the entry for `source` if it can be reused as is"""
+        entry = self.entries.get(source.as_posix())
+        if entry is None or entry.hash != digest or entry.deps != (deps or {}):
+            return None
+        if not all(Path(output).exists() for output in entry.outputs):
+            return None
+        return entry
+
+    def includes(self, source: Path) -> list[str]:
+        """The templates `source` included when it was last built"""
+        entry = self.entries.get(source.as_posix())
+        return entry.includes if entry is not None else []
+
+    def record(self, source: Path, entry: Entry):
+        self.entries[source.as_posix()] = entry
+
+    def prune(self, seen: set[str]) -> list[str]:
+        """Drop entries whose sources have gone, returning their stale outputs"""
+        stale = []
+        for key in set(self.entries) - seen:
+            stale.extend(self.entries.pop(key).outputs)
+        return stale
@@ -0,0 +1,90 @@
+import re
+from dataclasses import dataclass, field
+from html import unescape
+
+from jinja2 import Environment, nodes
+
+# Anything that can hide a `<handler>` tag, plus the tag itself
+_SCAN = re.compile(
+    r"<!--.*?-->|\{#.*?#\}|\{%-?\s*raw\s*-?%\}.*?\{%-?\s*endraw\s*-?%\}|(?P<handler><handler)(?=[\s/>])",
+    re.DOTALL | re.IGNORECASE,
+)
+_ATTRIBUTE = re.compile(
+    r"""\s*(?P<name>[^\s"'>/=]+)(?:\s*=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\s"'>]+)))?""",
+)
+_TAG_END = re.compile(r"\s*(/?)>")
+_CLOSE = re.compile(r"</handler\s*>", re.IGNORECASE)
+_DURATION = re.compile(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h|d)?\s*")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+_jinja_env = Environment()
+
+
+class PageSyntaxError(ValueError):
+    """Raised when a `<handler>` tag is not terminated or has a bad attribute"""
+
+
+@dataclass
+class Page:
+    """A `+page.sanic` file split into its handler code and template"""
+
+    template: str
+    handler: str | None = None
+    attrs: dict[str, str] = field(default_factory=dict)
+
+
+def parse_page(source: str) -> Page:
+    """Split out the first `<handler>` element of a page.
+
+    The handler's contents are returned verbatim, as are the parts of the
+    template either side of it, so whitespace in the page is never altered.
+    Tags inside HTML comments, Jinja comments and `{% raw %}` blocks are
+    ignored. Attribute names are lower-cased, as an HTML parser would.
+    """
+    for match in _SCAN.finditer(source):
+        if match.group("handler"):
+            break
+    else:
+        return Page(template=source)
+
+    attrs = {}
+    pos = match.end()
+    while not (end := _TAG_END.match(source, pos)):
+        if not (attribute := _ATTRIBUTE.match(source, pos)):
+            msg = f"Unterminated <handler> tag at offset {match.start()}"
+            raise PageSyntaxError(msg)
+        value = next((v for v in attribute.group("dq", "sq", "bare") if v is not None), "")
+        attrs.setdefault(attribute.group("name").lower(), unescape(value))
+        pos = attribute.end()
+
+    if end.group(1):
+        # <handler ... /> has no body
+        return Page(template=source[: match.start()] + source[end.end() :], handler="", attrs=attrs)
+
+    if not (close := _CLOSE.search(source, end.end())):
+        msg = f"Missing </handler> for the tag at offset {match.start()}"
+        raise PageSyntaxError(msg)
+
+    return Page(
+        template=source[: match.start()] + source[close.end() :],
+        handler=source[end.end() : close.start()],
+        attrs=attrs,
+    )
+
+
+def parse_duration(value: str) -> float:
+    """Convert a handler attribute like `"90"`, `"60s"`, `"5m"` or `"1h"` to seconds"""
+    if not (match := _DURATION.fullmatch(value)):
+        msg = f"Invalid duration: {value!r}"
+        raise PageSyntaxError(msg)
+    number, unit = match.groups()
+    return float(number) * _DURATION_UNITS[unit or "s"]
+
+
+def find_blocks(template: str) -> list[str]:
+    """The names of the `{% block %}`s in a template, nested ones included.
+
+    Only parses the template, so this is much cheaper than compiling it to
+    get at `Template.blocks`.
+    """
+    return [block.name for block in _jinja_env.parse(template).find_all(nodes.Block)]
@@ -0,0 +1,133 @@
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import perf_counter_ns
+
+from rich import print
+from rich.markup import escape
+from rich.table import Table
+
+# Events recorded in this process since the last `drain()`. Worker processes
+# hand theirs back with the entry they built.
+_events: list = []
+
+
+@dataclass(slots=True)
+class Event:
+    """A timed span of the build
+
+    `kind` is "phase" for the steps of `_build` itself, "route" for building a
+    whole source file and "step" for the parts of building one.
+    """
+
+    name: str
+    kind: str
+    start: int
+    duration: int
+    pid: int
+    route: str = ""
+
+
+@contextmanager
+def span(name: str, kind: str = "phase", route: str = ""):
+    """Time the body of the `with` block"""
+    start = perf_counter_ns()
+    try:
+        yield
+    finally:
+        _events.append(Event(name, kind, start, perf_counter_ns() - start, os.getpid(), route))
+
+
+class Stopwatch:
+    """Times consecutive phases: each `lap()` records the time since the last one"""
+
+    def __init__(self):
+        self.last = perf_counter_ns()
+
+    def lap(self, name: str):
+        now = perf_counter_ns()
+        _events.append(Event(name, "phase", self.last, now - self.last, os.getpid()))
+        self.last = now
+
+
+def drain() -> list[Event]:
+    """Return and forget the events recorded so far"""
+    events = _events[:]
+    _events.clear()
+    return events
+
+
+def record(events: list[Event]):
+    """Add events recorded in another process"""
+    _events.extend(events)
+
+
+def _ms(ns: int) -> str:
+    return f"{ns / 1e6:,.1f}"
+
+
+def print_profile(events: list[Event], top: int = 10):
+    """Print where the time went: each build phase, the per-route steps and the slowest routes"""
+    wall = sum(event.duration for event in events if event.kind == "phase")
+
+    phases = Table("Phase", "ms", "%", title="Build phases")
+    for event in events:
+        if event.kind == "phase":
+            phases.add_row(event.name, _ms(event.duration), f"{100 * event.duration / (wall or 1):.0f}")
+    phases.add_row("[bold]total", f"[bold]{_ms(wall)}", "")
+    print(phases)
+
+    steps = defaultdict(int)
+    routes = defaultdict(lambda: defaultdict(int))
+    for event in events:
+        if event.kind == "step":
+            steps[event.name] += event.duration
+            routes[event.route][event.name] += event.duration
+        elif event.kind == "route":
+            routes[event.route]["total"] += event.duration
+    if not routes:
+        return
+
+    # Routes may be built in parallel, so these add up to more than the wall time
+    per_step = Table("Step", "ms (all routes)", title="Route steps")
+    for name, duration in sorted(steps.items(), key=lambda item: -item[1]):
+        per_step.add_row(name, _ms(duration))
+    print(per_step)
+
+    slowest = Table("Route", "ms", "Slowest step", title=f"Slowest {min(top, len(routes))} of {len(routes)} routes")
+    for route, timings in sorted(routes.items(), key=lambda item: -item[1]["total"])[:top]:
+        step = max((name for name in timings if name != "total"), key=timings.get, default="")
+        slowest.add_row(escape(route), _ms(timings["total"]), f"{step} ({_ms(timings[step])})" if step else "")
+    print(slowest)
+
+
+def write_profile(events: list[Event], path: Path, format: str = "json"):
+    """Save the events, either as a plain list or as a Chrome trace
+
+    Chrome traces can be opened in `chrome://tracing` or https://ui.perfetto.dev
+    and show each worker process on its own track.
+    """
+    if format == "chrome":
+        origin = min((event.start for event in events), default=0)
+        data = {
+            "traceEvents": [
+                {
+                    "name": event.route if event.kind == "route" else event.name,
+                    "cat": event.kind,
+                    "ph": "X",
+                    "ts": (event.start - origin) / 1000,
+                    "dur": event.duration / 1000,
+                    "pid": 0,
+                    "tid": event.pid,
+                    "args": {"route": event.route} if event.route else {},
+                }
+                for event in events
+            ],
+            "displayTimeUnit": "ms",
+        }
+    else:
+        data = [asdict(event) for event in events]
+    Path(path).write_text(json.dumps(data, indent=1))
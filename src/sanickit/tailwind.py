@@ -0,0 +1,61 @@
+import os
+import re
+import subprocess
+from pathlib import Path
+
+from rich import print
+from rich.markup import escape
+
+TAILWIND_DIR = Path(".sanickit")
+TAILWIND_CONFIG = TAILWIND_DIR / "tailwind.config.js"
+# Every class candidate in the templates, one per line, kept in each build
+# slot. Tailwind scans this instead of the source tree
+CLASS_INDEX = "tailwind-classes.txt"
+
+# Runs of anything but whitespace, quotes and tag delimiters, keeping
+# arbitrary values like `[&>*]:p-2` whole. Like Tailwind's own extractor this
+# errs on the side of too many candidates: Tailwind ignores what isn't a class.
+_CANDIDATE = re.compile(r"(?:\[[^\]\s]*\]|[^\s\"'`<>=\[])+")
+
+
+def class_candidates(text: str) -> list[str]:
+    """The tokens in a template that could be Tailwind classes, sorted"""
+    return sorted({token for token in _CANDIDATE.findall(text) if len(token) < 100 and not token.isdigit()})
+
+
+def tailwind_executable() -> Path | None:
+    for name in ("tailwindcss.exe", "tailwindcss"):
+        if (executable := TAILWIND_DIR / name).exists():
+            return executable
+    return None
+
+
+def regenerate_css(executable: Path, index: Path, output: Path, quiet: bool = False) -> bool:
+    """Run Tailwind once over the class `index` and swap the result into `output`
+
+    The CSS is written next to `output` first and then renamed over it, so
+    the server never sees a half written file. If Tailwind fails the old CSS
+    is kept.
+    """
+    partial = output.with_name(f".{output.name}.tmp")
+    result = subprocess.run(
+        [
+            executable,
+            "--content",
+            index,
+            "--output",
+            partial,
+            "--config",
+            TAILWIND_CONFIG,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0 or not partial.exists():
+        print(f"[red]Tailwind failed:[/red] {escape(result.stderr.strip())}")
+        partial.unlink(missing_ok=True)
+        return False
+    os.replace(partial, output)
+    if not quiet:
+        print(f"[green]Regenerated[/green] {output}")
+    return True
@@ -0,0 +1,47 @@
+from hashlib import blake2b
+
+from sanic import HTTPResponse, Sanic
+
+app = Sanic.get_app()
+
+# Headers that a 304 response should repeat from the full response
+KEPT_HEADERS = ("cache-control", "content-location", "expires", "vary")
+
+
+def etag_for(body: bytes) -> str:
+    return f'"{blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+
+@app.on_response
+async def conditional_get(request, response):
+    """
+    Give successful GET responses an ETag and answer a matching If-None-Match
+    with 304 Not Modified.
+
+    A handler can supply its own ETag (e.g. a version number from the
+    database) by setting the header itself. Otherwise the ETag is a hash of
+    the body. Streamed responses (whose body is empty here) and static files,
+    which carry Last-Modified, are left alone.
+    """
+    if request.method not in ("GET", "HEAD") or response.status != 200:
+        return None
+
+    if (etag := response.headers.get("ETag")) is None:
+        if not response.body or "last-modified" in response.headers:
+            return None
+        etag = response.headers["ETag"] = etag_for(response.body)
+
+    if (if_none_match := request.headers.get("If-None-Match")) and etag_matches(if_none_match, etag):
+        headers = {"ETag": etag}
+        headers.update((name, value) for name, value in response.headers.items() if name.lower() in KEPT_HEADERS)
+        return HTTPResponse(status=304, headers=headers)
+
+    return None
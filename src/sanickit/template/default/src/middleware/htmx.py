@@ -1,59 +1,89 @@
 import json
-from functools import cached_property
-from typing import Any, Optional
+from types import SimpleNamespace
+from typing import Any, Optional, Union
 from urllib.parse import unquote
 
-from sanic import Sanic
-from sanic.log import logger
+from sanic import HTTPResponse, Request, Sanic
 
 app = Sanic.get_app()
 
+AUTO_ENCODED = "-uri-autoencoded"
+# Marks a header that hasn't been read yet, as None is kept for missing ones
+_UNREAD = object()
+
+# The response header for each stage `trigger()` can fire an event at
+TRIGGER_HEADERS = {
+    "receive": "HX-Trigger",
+    "settle": "HX-Trigger-After-Settle",
+    "swap": "HX-Trigger-After-Swap",
+}
+
 
 class HtmxDetails:
-    def __init__(self, request) -> None:
-        self.request = request
-
-    def _get_header_value(self, name: str) -> Optional[str]:
-        value = self.request.headers.get(name) or None
-        if value:
-            if self.request.headers.get(f"{name}-URI-AutoEncoded") == "true":
-                value = unquote(value)
-        return value
+    """
+    The htmx headers of `request`, each read when it is first asked for and
+    kept for later reads.
+
+    Read-only. Falsy for requests that htmx didn't make.
+    """
+
+    __slots__ = ("request", "_headers", "_values")
+
+    def __init__(self, request: Request) -> None:
+        object.__setattr__(self, "request", request)
+        object.__setattr__(self, "_headers", request.headers)
+        object.__setattr__(self, "_values", {})
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"HtmxDetails is read-only, can't set {name}")
 
     def __bool__(self) -> bool:
-        return self._get_header_value("HX-Request") == "true"
+        # htmx sends its other headers along with HX-Request
+        return self._value("hx-request") == "true"
+
+    def _value(self, name: str) -> Optional[str]:
+        if (value := self._values.get(name, _UNREAD)) is not _UNREAD:
+            return value
+        # Sanic has already lowercased the header names
+        value = self._headers.get(name) or None
+        # htmx only flags values it had to percent-encode, so the flag needs
+        # looking up for those alone
+        if value is not None and "%" in value and self._headers.get(name + AUTO_ENCODED) == "true":
+            value = unquote(value)
+        self._values[name] = value
+        return value
 
-    @cached_property
+    @property
     def boosted(self) -> bool:
-        return self._get_header_value("HX-Boosted") == "true"
-
-    @cached_property
-    def current_url(self) -> Optional[str]:
-        return self._get_header_value("HX-Current-URL")
+        return self._value("hx-boosted") == "true"
 
-    @cached_property
+    @property
     def history_restore_request(self) -> bool:
-        return self._get_header_value("HX-History-Restore-Request") == "true"
+        return self._value("hx-history-restore-request") == "true"
 
-    @cached_property
+    @property
+    def current_url(self) -> Optional[str]:
+        return self._value("hx-current-url")
+
+    @property
     def prompt(self) -> Optional[str]:
-        return self._get_header_value("HX-Prompt")
+        return self._value("hx-prompt")
 
-    @cached_property
+    @property
     def target(self) -> Optional[str]:
-        return self._get_header_value("HX-Target")
+        return self._value("hx-target")
 
-    @cached_property
+    @property
     def trigger(self) -> Optional[str]:
-        return self._get_header_value("HX-Trigger")
+        return self._value("hx-trigger")
 
-    @cached_property
+    @property
     def trigger_name(self) -> Optional[str]:
-        return self._get_header_value("HX-Trigger-Name")
+        return self._value("hx-trigger-name")
 
-    @cached_property
+    @property
     def triggering_event(self) -> Any:
-        value = self._get_header_value("Triggering-Event")
+        value = self._value("triggering-event")
         if value is not None:
             try:
                 value = json.loads(value)
@@ -62,7 +92,55 @@ class HtmxDetails:
         return value
 
 
-@app.on_request
-async def check_htmx(request):
-    details = HtmxDetails(request)
-    request.ctx.htmx = details
+class LazyHtmx:
+    """Makes `request.ctx.htmx` on first read and stores it on the context, which later reads find first"""
+
+    def __get__(self, ctx: "HtmxContext", owner=None) -> Any:
+        if ctx is None:
+            return self
+        ctx.htmx = HtmxDetails(ctx._request)
+        return ctx.htmx
+
+
+class HtmxContext(SimpleNamespace):
+    """`request.ctx`, with `htmx` made the first time a handler reads it"""
+
+    # A slot rather than an attribute, to keep it out of the namespace
+    __slots__ = ("_request",)
+
+    htmx = LazyHtmx()
+
+    def __init__(self, request: Request) -> None:
+        self._request = request
+
+
+class HtmxRequest(app.request_class):
+    def make_context(self) -> HtmxContext:
+        return HtmxContext(self)
+
+
+# Sanic makes `request.ctx` on first use, so requests that never read
+# `request.ctx.htmx` (static files, most API calls) pay nothing for it
+app.request_class = HtmxRequest
+
+
+def push_url(response: HTTPResponse, url: Union[str, bool]) -> HTTPResponse:
+    """Push `url` (or, with False, nothing) onto the browser history"""
+    response.headers["HX-Push-Url"] = url if isinstance(url, str) else str(url).lower()
+    return response
+
+
+def trigger(response: HTTPResponse, event: Union[str, dict], after: str = "receive") -> HTTPResponse:
+    """
+    Fire client side events when the response is received, or after the swap
+    or settle step. `event` is an event name or, to pass details, a dict of
+    event names to details.
+    """
+    response.headers[TRIGGER_HEADERS[after]] = event if isinstance(event, str) else json.dumps(event)
+    return response
+
+
+def reswap(response: HTTPResponse, swap: str) -> HTTPResponse:
+    """Swap the response in another way than the element's hx-swap says, e.g. `outerHTML`"""
+    response.headers["HX-Reswap"] = swap
+    return response
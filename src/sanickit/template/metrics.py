@@ -0,0 +1,377 @@
+"""
+Request metrics for the generated app, served in the Prometheus text format.
+
+Turned on with `metrics = true` in the `[sanickit]` config. Each worker counts
+into plain Python objects, so recording a request costs a few additions, and
+writes a snapshot of its counts to a directory shared by the workers every few
+seconds. `/metrics` adds the worker's live counts to the other workers'
+snapshots, so whichever worker answers the scrape reports the whole server.
+"""
+import asyncio
+import json
+import os
+import shutil
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from tempfile import mkdtemp
+from time import perf_counter_ns
+
+from jinja2 import Template
+from sanic import HTTPResponse, Sanic
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_BUCKETS_NS = tuple(int(bound * 1e9) for bound in BUCKETS)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_ROUTE = "sanickit_metrics"
+
+# The sample of the request being handled, for the template and cache hooks
+_sample: ContextVar = ContextVar("sanickit_metrics_sample", default=None)
+
+
+class Sample:
+    """What is known about one request while it is being handled"""
+
+    __slots__ = (
+        "route",
+        "start",
+        "handler_ns",
+        "render_ns",
+        "queue_ns",
+        "kind",
+        "cache",
+        "status",
+        "timed",
+        "running",
+    )
+
+    def __init__(self, route: str):
+        self.route = route
+        self.start = perf_counter_ns()
+        self.handler_ns = 0
+        self.render_ns = 0
+        # How long a sync handler waited for a thread, None for async handlers
+        self.queue_ns = None
+        # "page" or "fragment" once something is rendered
+        self.kind = "other"
+        # True for a response cache hit, False for a miss
+        self.cache = None
+        self.status = None
+        # Whether it reached a timed route handler, and whether that is still running
+        self.timed = False
+        self.running = False
+
+
+class RouteStats:
+    """The counts for one route, in one worker or merged over all of them"""
+
+    __slots__ = (
+        "requests",
+        "buckets",
+        "latency_ns",
+        "handler_ns",
+        "handled",
+        "render_ns",
+        "renders",
+        "queue_ns",
+        "queued",
+        "cache",
+    )
+
+    def __init__(self):
+        # "<kind> <status>" to count
+        self.requests: dict = {}
+        # Not cumulative: the last bucket counts everything over the largest bound
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.latency_ns = 0
+        self.handler_ns = 0
+        self.handled = 0
+        self.render_ns = 0
+        self.renders = 0
+        self.queue_ns = 0
+        self.queued = 0
+        # Response cache [hits, misses]
+        self.cache = [0, 0]
+
+    def record(self, sample: Sample, latency_ns: int):
+        key = f"{sample.kind} {sample.status}"
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self.buckets[bisect_left(_BUCKETS_NS, latency_ns)] += 1
+        self.latency_ns += latency_ns
+        if sample.timed:
+            # Time in the handler itself, leaving out rendering and waiting for a thread
+            self.handler_ns += sample.handler_ns - sample.render_ns - (sample.queue_ns or 0)
+            self.handled += 1
+        if sample.queue_ns is not None:
+            self.queue_ns += sample.queue_ns
+            self.queued += 1
+        if sample.kind != "other":
+            self.render_ns += sample.render_ns
+            self.renders += 1
+        if sample.cache is not None:
+            self.cache[0 if sample.cache else 1] += 1
+
+    def merge(self, other: dict):
+        for key, count in other["requests"].items():
+            self.requests[key] = self.requests.get(key, 0) + count
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other["buckets"])]
+        self.latency_ns += other["latency_ns"]
+        self.handler_ns += other["handler_ns"]
+        self.handled += other["handled"]
+        self.render_ns += other["render_ns"]
+        self.renders += other["renders"]
+        self.queue_ns += other.get("queue_ns", 0)
+        self.queued += other.get("queued", 0)
+        self.cache = [mine + theirs for mine, theirs in zip(self.cache, other["cache"])]
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Metrics:
+    """The counts of one worker, and the snapshots it shares with the others"""
+
+    def __init__(self):
+        self.routes: dict = {}
+        # Where the workers' snapshots go. None when there is only this process
+        self.directory = None
+
+    def begin(self, request):
+        """Request middleware: start timing a routed request"""
+        route = request.route
+        if route is None or route.name.endswith(METRICS_ROUTE):
+            _sample.set(None)
+            return
+        _sample.set(Sample(route.name.rpartition(".")[2]))
+
+    def finish(self, request, response):
+        """Response middleware: record the request, unless its handler is still streaming the body"""
+        if (sample := _sample.get()) is None:
+            return
+        sample.status = response.status
+        if not sample.running:
+            self.record(sample)
+            _sample.set(None)
+
+    def timed(self, handler, fragment: bool = False):
+        """Wrap a route handler to time it apart from the middleware around it"""
+
+        @wraps(handler)
+        async def timed_handler(request, **kwargs):
+            if (sample := _sample.get()) is None:
+                return await handler(request, **kwargs)
+            if fragment:
+                sample.kind = "fragment"
+            sample.timed = sample.running = True
+            start = perf_counter_ns()
+            try:
+                return await handler(request, **kwargs)
+            finally:
+                sample.handler_ns += perf_counter_ns() - start
+                sample.running = False
+                if sample.status is not None:
+                    # A streamed response: the response middleware ran when it started
+                    self.record(sample)
+                    _sample.set(None)
+
+        return timed_handler
+
+    def record(self, sample: Sample):
+        if (stats := self.routes.get(sample.route)) is None:
+            stats = self.routes[sample.route] = RouteStats()
+        stats.record(sample, perf_counter_ns() - sample.start)
+
+    def snapshot(self) -> dict:
+        return {route: stats.to_dict() for route, stats in self.routes.items()}
+
+    def flush(self):
+        """Write this worker's counts for the other workers to read"""
+        if self.directory is None:
+            return
+        path = self.directory / f"{os.getpid()}.json"
+        partial = path.with_suffix(".tmp")
+        partial.write_text(json.dumps(self.snapshot()))
+        os.replace(partial, path)
+
+    def collect(self) -> dict:
+        """The counts of every worker: this one's live, the others' from their last snapshot"""
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            for path in self.directory.glob("*.json"):
+                if path.stem == str(os.getpid()):
+                    continue
+                try:
+                    snapshots.append(json.loads(path.read_text()))
+                except (OSError, ValueError):
+                    continue
+        merged: dict = {}
+        for snapshot in snapshots:
+            for route, stats in snapshot.items():
+                merged.setdefault(route, RouteStats()).merge(stats)
+        return merged
+
+    def exposition(self) -> str:
+        """Every route's counts in the Prometheus text format"""
+        routes = sorted(self.collect().items())
+        lines = [
+            "# HELP sanickit_requests_total Requests handled, by route, what was rendered and status.",
+            "# TYPE sanickit_requests_total counter",
+        ]
+        for route, stats in routes:
+            for key, count in sorted(stats.requests.items()):
+                kind, _, status = key.partition(" ")
+                labels = f'route="{_label(route)}",kind="{kind}",status="{status}"'
+                lines.append(f"sanickit_requests_total{{{labels}}} {count}")
+
+        lines += [
+            "# HELP sanickit_request_duration_seconds Time from routing a request to its response.",
+            "# TYPE sanickit_request_duration_seconds histogram",
+        ]
+        for route, stats in routes:
+            label = _label(route)
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), stats.buckets):
+                cumulative += count
+                lines.append(f'sanickit_request_duration_seconds_bucket{{route="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'sanickit_request_duration_seconds_sum{{route="{label}"}} {stats.latency_ns / 1e9}')
+            lines.append(f'sanickit_request_duration_seconds_count{{route="{label}"}} {cumulative}')
+
+        for name, help, total, count in (
+            ("handler", "Time in route handlers, leaving out rendering.", "handler_ns", "handled"),
+            ("render", "Time rendering templates and fragments.", "render_ns", "renders"),
+            ("thread_queue", "Time sync handlers waited for a thread.", "queue_ns", "queued"),
+        ):
+            lines += [f"# HELP sanickit_{name}_seconds {help}", f"# TYPE sanickit_{name}_seconds summary"]
+            for route, stats in routes:
+                if getattr(stats, count):
+                    label = _label(route)
+                    lines.append(f'sanickit_{name}_seconds_sum{{route="{label}"}} {getattr(stats, total) / 1e9}')
+                    lines.append(f'sanickit_{name}_seconds_count{{route="{label}"}} {getattr(stats, count)}')
+
+        lines += [
+            "# HELP sanickit_response_cache_total Lookups in the rendered response cache.",
+            "# TYPE sanickit_response_cache_total counter",
+        ]
+        for route, stats in routes:
+            if any(stats.cache):
+                label = _label(route)
+                lines.append(f'sanickit_response_cache_total{{route="{label}",result="hit"}} {stats.cache[0]}')
+                lines.append(f'sanickit_response_cache_total{{route="{label}",result="miss"}} {stats.cache[1]}')
+        return "\n".join(lines) + "\n"
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class timing_render:
+    """Add the time spent in the block to the current request's render time"""
+
+    __slots__ = ("fragment", "sample", "start")
+
+    def __init__(self, fragment: bool = False):
+        self.fragment = fragment
+
+    def __enter__(self):
+        self.sample = sample = _sample.get()
+        if sample is not None:
+            if self.fragment or sample.kind == "other":
+                sample.kind = "fragment" if self.fragment else "page"
+            self.start = perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        if self.sample is not None:
+            self.sample.render_ns += perf_counter_ns() - self.start
+
+
+def count_cache(hit: bool):
+    """Note whether the current request was answered from the response cache"""
+    if (sample := _sample.get()) is not None:
+        sample.cache = hit
+
+
+def count_queue(queue_ns: int):
+    """Note how long the current request's sync handler waited for a thread"""
+    if (sample := _sample.get()) is not None:
+        sample.queue_ns = queue_ns
+
+
+class TimedTemplate(Template):
+    """Times whole page renders, including the ones streamed by `stream_template`"""
+
+    async def render_async(self, *args, **kwargs):
+        with timing_render():
+            return await super().render_async(*args, **kwargs)
+
+    async def generate_async(self, *args, **kwargs):
+        if (sample := _sample.get()) is None:
+            async for part in super().generate_async(*args, **kwargs):
+                yield part
+            return
+        if sample.kind == "other":
+            sample.kind = "page"
+        start = perf_counter_ns()
+        async for part in super().generate_async(*args, **kwargs):
+            sample.render_ns += perf_counter_ns() - start
+            yield part
+            start = perf_counter_ns()
+        sample.render_ns += perf_counter_ns() - start
+
+
+def setup_metrics(app: Sanic) -> Metrics:
+    """
+    Record every routed request and serve the counts on `/metrics` (or
+    `METRICS_PATH`). The workers share their counts through `METRICS_DIR`,
+    a temporary directory made by the main process unless one is configured.
+    Snapshots are written every `METRICS_FLUSH_INTERVAL` seconds.
+    """
+    metrics = Metrics()
+    app.ctx.metrics = metrics
+    app.ext.templating.environment.template_class = TimedTemplate
+    app.on_request(metrics.begin, priority=1000)
+    app.on_response(metrics.finish, priority=-1000)
+
+    made = []
+
+    @app.main_process_start
+    def make_directory(app):
+        if not app.config.get("METRICS_DIR"):
+            # Workers are started with this environment, and Sanic reads SANIC_* into the config
+            os.environ["SANIC_METRICS_DIR"] = app.config.METRICS_DIR = mkdtemp(prefix="sanickit-metrics-")
+            made.append(app.config.METRICS_DIR)
+
+    @app.main_process_stop
+    def remove_directory(app):
+        for directory in made:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    @app.before_server_start
+    async def share(app):
+        if directory := app.config.get("METRICS_DIR"):
+            metrics.directory = Path(directory)
+            metrics.directory.mkdir(exist_ok=True, parents=True)
+            app.add_task(flush_periodically(metrics, app.config.get("METRICS_FLUSH_INTERVAL", 5)))
+
+    @app.before_server_stop
+    async def flush(app):
+        metrics.flush()
+
+    async def serve_metrics(request):
+        return HTTPResponse(metrics.exposition(), content_type=CONTENT_TYPE)
+
+    app.add_route(
+        serve_metrics,
+        app.config.get("METRICS_PATH", "/metrics"),
+        methods=["GET"],
+        name=METRICS_ROUTE,
+        error_format="text",
+    )
+    return metrics
+
+
+async def flush_periodically(metrics: Metrics, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        metrics.flush()
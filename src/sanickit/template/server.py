@@ -1,9 +1,18 @@
+import json
+import os
+import sys
+from asyncio import Semaphore, get_running_loop
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial, wraps
 from importlib import import_module
+from inspect import isawaitable
 from pathlib import Path
+from time import monotonic, perf_counter_ns
 from typing import Optional, Sequence, Tuple
 
-from jinja2.ext import Extension
-from jinja2.lexer import Token
+from jinja2 import ChoiceLoader, ModuleLoader
 # Modules imported here should NOT have a Sanic.get_app() call in the global
 # scope. Doing so will cause a circular import. Therefore, we progromatically
 # import those modules inside of the create_app() factory.
@@ -11,70 +20,471 @@ from jinja2.lexer import Token
 # from app.common.csrf import setup_csrf
 # from app.common.log import setup_logging
 # from app.common.pagination import setup_pagination
-from sanic import Sanic
-
-
-class RelativeInclude(Extension):
-    def preprocess(self, source, name, filename=None):
-        self.name = name
-        self.filename = filename
-        return source
-
-    def filter_stream(self, stream):
-        in_include_tag = False
-        for token in stream:
-            match token:
-                case Token(type="name", value="include"):
-                    in_include_tag = True
-                    yield token
-                case Token(type="block_end") if in_include_tag:
-                    in_include_tag = False
-                    yield token
-                case Token(type="string") if in_include_tag and token.value.startswith("."):
-                    new_token = Token(
-                        lineno=token.lineno,
-                        type=token.type,
-                        value=str(Path(self.filename).relative_to("templates").parent / token.value),
-                    )
-                    yield new_token
-                case _:
-                    yield token
+from sanic import Blueprint, HTTPResponse, Sanic
+from sanic.exceptions import NotFound
+from sanic.response import empty, file
+from sanic.response import json as json_response
+from sanic.response.convenience import guess_content_type
+
+from .metrics import Metrics, count_cache, count_queue, setup_metrics, timing_render
+
+STATIC = Path(__file__).parent / "static"
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Precompressed variants written by `sk build --production`, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Where `sk run` posts the handler modules and templates changed by a rebuild
+HOT_RELOAD_PATH = "/_sanickit/reload"
+# Written by the build: the templates each template includes, imports or extends
+TEMPLATE_DEPS = Path(__file__).parent / "template_deps.json"
+
+
+class Fragment:
+    """
+    A single block of a page template, rendered on its own for htmx requests.
+
+    The builder registers a route per block with its `Fragment` bound to the
+    handler, so no per-request block search is needed. The block's render
+    function is looked up the first time it's used and kept from then on.
+    """
+
+    _fragments: dict = {}
+
+    __slots__ = ("template_name", "block", "_template", "_render")
+
+    def __init__(self, template_name: str, block: str):
+        self.template_name = template_name
+        self.block = block
+        self._template = None
+        self._render = None
+
+    @classmethod
+    def get(cls, template_name: str, block: str) -> "Fragment":
+        key = (template_name, block)
+        if (fragment := cls._fragments.get(key)) is None:
+            fragment = cls._fragments[key] = cls(template_name, block)
+        return fragment
+
+    @classmethod
+    def reset(cls, templates: Optional[set] = None):
+        """Forget the looked up blocks of the given (or every) template, e.g. after a rebuild"""
+        for fragment in cls._fragments.values():
+            if templates is None or fragment.template_name in templates:
+                fragment._template = fragment._render = None
+
+    async def render(self, environment, context) -> str:
+        if self._render is None:
+            self._template = environment.get_template(self.template_name)
+            self._render = self._template.blocks[self.block]
+        ctx = self._template.new_context(context)
+        with timing_render(fragment=True):
+            return environment.concat([part async for part in self._render(ctx)])
+
+
+class ResponseCache:
+    """
+    An in-process LRU cache of rendered responses, each kept for its own TTL.
+
+    Every worker has its own cache. Hits and misses are counted per handler.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        if (entry := self._entries.get(key)) is None:
+            return None
+        expires, cached = entry
+        if expires < monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return cached
+
+    def set(self, key, ttl: float, response: HTTPResponse):
+        self._entries[key] = (monotonic() + ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def cache_response(ttl: float, vary: Sequence[str] = ()):
+    """
+    Cache a page handler's successful responses for `ttl` seconds.
+
+    Responses are keyed on the handler, its path parameters, the fragment
+    being rendered, the query string and the values of the `vary` request
+    headers. Responses that set cookies are never cached.
+    """
+
+    def decorator(handler):
+        name = handler.__name__
+
+        @wraps(handler)
+        async def cached(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return await handler(request, *args, **kwargs)
+
+            key = (
+                name,
+                args,
+                tuple(sorted(kwargs.items(), key=lambda item: item[0])),
+                request.query_string,
+                tuple(request.headers.get(header) for header in vary),
+            )
+            if (hit := response_cache.get(key)) is not None:
+                response_cache.hits[name] += 1
+                count_cache(True)
+                body, status, headers, content_type = hit
+                return HTTPResponse(body, status=status, headers=headers, content_type=content_type)
+
+            response_cache.misses[name] += 1
+            count_cache(False)
+            response = await handler(request, *args, **kwargs)
+            if (
+                response is not None
+                and response.status == 200
+                and response.body is not None
+                and "set-cookie" not in response.headers
+            ):
+                response_cache.set(
+                    key, ttl, (response.body, response.status, dict(response.headers), response.content_type)
+                )
+            return response
+
+        return cached
+
+    return decorator
+
+
+async def stream_template(request, template_name: str, context, *, max_chunk: int = 64 * 1024):
+    """
+    Render a template straight into a streaming response.
+
+    Output is sent in chunks that start at 1 KiB, so the `<head>` reaches the
+    browser straight away, and double up to `max_chunk` to keep the number of
+    writes down for very large pages.
+    """
+    environment = request.app.ext.environment
+    template = environment.get_template(template_name)
+    context = dict(context, request=request)
+
+    response = await request.respond(content_type="text/html; charset=utf-8")
+    buffer, size, chunk = [], 0, 1024
+    async for part in template.generate_async(context):
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk:
+            await response.send("".join(buffer))
+            buffer, size, chunk = [], 0, min(chunk * 2, max_chunk)
+    await response.send("".join(buffer))
+    await response.eof()
 
 
 # from .blueprints.app import bp as app_bp
 
 DEFAULT: Tuple[str, ...] = (
-    "app.blueprints.app",
+    "app.registry",
     "app.middleware.htmx",
     # "app.middleware.request_context",
     # "app.middleware.redirect",
 )
 
 
-def load_modules(path):
-    for module in (Path(__file__).parent / path).glob("*.py"):
-        if module.stem == "__init__":
-            continue
-        yield import_module(f"app.{path}.{module.stem}")
+# Handlers that have been imported, keyed on (module, handler, fragment)
+_handlers: dict = {}
 
 
-def setup_blueprints(app: Sanic):
+def load_handler(module: str, handler: str, fragment=None):
+    target = getattr(import_module(module), handler)
+    if fragment:
+        target = partial(target, fragment=Fragment.get(*fragment))
+    return target
+
+
+def lazy_handler(module: str, handler: str, fragment=None):
     """
-    Load the blueprints
+    A route handler that only imports the generated handler module (and so
+    everything the handler imports) the first time the route is requested
+    """
+    key = (module, handler, tuple(fragment) if fragment else None)
+
+    async def route_handler(request, **kwargs):
+        if (target := _handlers.get(key)) is None:
+            target = _handlers[key] = load_handler(*key)
+        return await target(request, **kwargs)
+
+    route_handler.__name__ = handler
+    return route_handler
+
+
+def threaded_handler(module: str, handler: str, limit: int):
     """
-    for module in load_modules("blueprints"):
+    A route handler that runs a sync generated handler on the worker's thread
+    pool, with at most `limit` requests to the route running at once. Other
+    requests to the route wait here rather than in the pool's queue, so one
+    slow route can't take every thread.
+    """
+    key = (module, handler, None)
+    semaphore = Semaphore(limit)
+
+    async def route_handler(request, **kwargs):
+        if (target := _handlers.get(key)) is None:
+            target = _handlers[key] = load_handler(*key)
+        queued = perf_counter_ns()
+        # So the handler still sees the current request, e.g. for Request.get_current()
+        context = copy_context()
+
+        def run():
+            count_queue(perf_counter_ns() - queued)
+            return target(request, **kwargs)
+
+        async with semaphore:
+            response = await get_running_loop().run_in_executor(request.app.ctx.thread_pool, context.run, run)
+        if isawaitable(response):
+            # e.g. `return render(...)`
+            response = await response
+        return response
+
+    route_handler.__name__ = handler
+    return route_handler
+
+
+def setup_thread_pool(app: Sanic):
+    """
+    Make the pool sync handlers run on: `THREAD_POOL_SIZE` threads per worker,
+    by default as many as `ThreadPoolExecutor` would start. A route may use
+    `THREAD_ROUTE_LIMIT` of them at once (half the pool by default) unless its
+    handler is decorated with `@concurrency(n)`.
+    """
+    size = int(app.config.get("THREAD_POOL_SIZE") or min(32, (os.cpu_count() or 1) + 4))
+    app.ctx.thread_route_limit = int(app.config.get("THREAD_ROUTE_LIMIT") or max(1, size // 2))
+
+    @app.before_server_start
+    async def start_threads(app):
+        # Made per server start, as a stopped pool can't be restarted. Threads
+        # are only started when there is work for them
+        app.ctx.thread_pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sanickit")
+
+    @app.after_server_stop
+    async def stop_threads(app):
+        app.ctx.thread_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def options_handler(allow: str):
+    """
+    Answer OPTIONS for a generated route as Sanic Extensions would. Adding
+    these with the routes spares its auto OPTIONS from adding them one at a
+    time at startup, finalizing the router again for each
+    """
+
+    async def route_handler(request, **kwargs):
+        return empty(headers={"allow": allow})
+
+    return route_handler
+
+
+def load_modules(names: Sequence[str]):
+    for name in names:
+        yield import_module(name)
+
+
+def setup_blueprints(app: Sanic, metrics: Optional[Metrics] = None):
+    """
+    Load the blueprints and register the routes listed in the registry, timing
+    each handler when metrics are on. Sync handlers run on the thread pool.
+    GET routes also answer HEAD, and each URL answers OPTIONS
+    """
+    registry = import_module("app.registry")
+    for module in load_modules(registry.BLUEPRINTS):
         if bp := getattr(module, "bp", None):
             app.blueprint(bp)
 
+    bp = Blueprint("app_blueprint")
+    methods: dict = {}
+    for uri, method, name, module, handler, fragment, error_format, threads in registry.ROUTES:
+        route_methods = [method, "HEAD"] if method == "GET" else [method]
+        methods.setdefault(uri, (name, error_format, set()))[2].update(route_methods)
+        if threads is None:
+            route_handler = lazy_handler(module, handler, fragment)
+        else:
+            route_handler = threaded_handler(module, handler, threads or app.ctx.thread_route_limit)
+        if metrics is not None:
+            route_handler = metrics.timed(route_handler, fragment=bool(fragment))
+        # The build works out the error format, as Sanic can't see the real handler through the wrapper
+        bp.add_route(
+            route_handler,
+            uri,
+            methods=route_methods,
+            name=name,
+            error_format=error_format or None,
+        )
+    for uri, (name, error_format, allowed) in methods.items():
+        if "OPTIONS" not in allowed:
+            allow = ",".join([*sorted(allowed), "OPTIONS"])
+            bp.add_route(
+                options_handler(allow),
+                uri,
+                methods=["OPTIONS"],
+                name=f"{name}_options",
+                error_format=error_format or None,
+            )
+    app.blueprint(bp)
+
+
+def hot_reload(app: Sanic, modules: Sequence[str], templates: Sequence[str]):
+    """
+    Pick up a rebuild without restarting: the given handler modules are
+    re-imported on their next request and the given templates are reloaded
+    """
+    modules = set(modules)
+    for key in [key for key in _handlers if key[0] in modules]:
+        del _handlers[key]
+    for module in modules:
+        sys.modules.pop(module, None)
+
+    environment = app.ext.templating.environment
+    templates = template_dependents(set(templates))
+    if environment.cache is not None:
+        for key in [key for key in environment.cache.keys() if key[1] in templates]:
+            del environment.cache[key]
+    Fragment.reset(templates)
+    response_cache.clear()
+
+
+def template_dependents(templates: set) -> set:
+    """The given templates and every template that includes, imports or extends them, however indirectly"""
+    graph = json.loads(TEMPLATE_DEPS.read_text()) if TEMPLATE_DEPS.exists() else {}
+    users: dict = {}
+    for template, references in graph.items():
+        for reference in references:
+            users.setdefault(reference, []).append(template)
+
+    found, pending = set(templates), list(templates)
+    while pending:
+        for user in users.get(pending.pop(), ()):
+            if user not in found:
+                found.add(user)
+                pending.append(user)
+    return found
+
+
+def setup_hot_reload(app: Sanic):
+    """
+    In development (`SANIC_HOT_RELOAD=true`), let the builder tell the app
+    which handler modules and templates a rebuild changed
+    """
+    if not app.config.get("HOT_RELOAD"):
+        return
+
+    async def reload_changed(request):
+        if request.ip not in ("127.0.0.1", "::1"):
+            raise NotFound("Not found")
+        changes = request.json
+        hot_reload(request.app, changes["modules"], changes["templates"])
+        return json_response({"modules": len(changes["modules"]), "templates": len(changes["templates"])})
+
+    app.add_route(reload_changed, HOT_RELOAD_PATH, methods=["POST"], name="sanickit_hot_reload", error_format="json")
+
 
 def setup_middleware(app: Sanic):
     """
     Load the middleware
     """
-    for module in load_modules("middleware"):
+    for module in load_modules(import_module("app.registry").MIDDLEWARE):
         pass  # Don't need to do anything
 
 
+def accepted_encodings(accept_encoding: str) -> set:
+    """The content codings a client accepts, leaving out any given `q=0`"""
+    accepted = set()
+    for coding in accept_encoding.lower().split(","):
+        coding, _, params = coding.partition(";")
+        name, _, value = params.partition("=")
+        try:
+            weight = float(value) if name.strip() == "q" else 1.0
+        except ValueError:
+            weight = 1.0
+        if weight > 0 and (coding := coding.strip()):
+            accepted.add(coding)
+    return accepted
+
+
+def static_handler(fingerprinted: set):
+    """
+    Serve the static files of a production build. Fingerprinted files can be
+    cached forever, and a gzip or brotli variant is sent in place of the file
+    when the client accepts it.
+    """
+
+    async def serve_static(request, path: str):
+        # STATIC goes through the build/current link, so resolve both
+        static = STATIC.resolve()
+        location = (static / path).resolve()
+        if static not in location.parents or not location.is_file():
+            raise NotFound("File not found")
+
+        headers = {"cache-control": IMMUTABLE if path in fingerprinted else "no-cache"}
+        content_type = guess_content_type(location)
+        variants = [(encoding, location.with_name(location.name + suffix)) for encoding, suffix in ENCODINGS]
+        if variants := [(encoding, variant) for encoding, variant in variants if variant.is_file()]:
+            headers["vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+            for encoding, variant in variants:
+                if encoding in accepted or "*" in accepted:
+                    headers["content-encoding"] = encoding
+                    location = variant
+                    break
+
+        return await file(location, mime_type=content_type, headers=headers, request_headers=request.headers)
+
+    return serve_static
+
+
+def setup_static(app: Sanic):
+    """
+    Serve `static/`, and give templates a `static_url()` that links to the
+    fingerprinted copy of a file when the build made one
+    """
+    manifest = Path(__file__).parent / "static.json"
+    files = json.loads(manifest.read_text())["files"] if manifest.exists() else {}
+
+    if files:
+        app.add_route(
+            static_handler(set(files.values())),
+            "/static/<path:path>",
+            methods=["GET", "HEAD"],
+            name="static",
+            error_format="text",
+        )
+    else:
+        app.static("/static/", STATIC)
+
+    def static_url(path: str) -> str:
+        return f"/static/{files.get(path, path)}"
+
+    app.ext.templating.environment.globals["static_url"] = static_url
+
+
+def setup_compiled_templates(app: Sanic):
+    """
+    Prefer the templates precompiled by `sk build --production`, falling back
+    to compiling from source for anything that isn't there
+    """
+    compiled = Path(__file__).parent.parent / "compiled_templates"
+    if compiled.is_dir():
+        environment = app.ext.templating.environment
+        environment.loader = ChoiceLoader([ModuleLoader(compiled), environment.loader])
+
+
 def create_app(namespace, module_names: Optional[Sequence[str]] = None) -> Sanic:
     """
     Application factory: responsible for gluing all of the pieces of the
@@ -88,16 +498,21 @@ def create_app(namespace, module_names: Optional[Sequence[str]] = None) -> Sanic
         module_names = DEFAULT
 
     app = Sanic("myapp")
-    app.static("/static/", Path(__file__).parent / "static")
+    setup_static(app)
     app.config.CSRF_REF_PADDING = 12
     app.config.CSRF_REF_LENGTH = 18
-    app.ext.templating.environment.add_extension(RelativeInclude)
+    setup_compiled_templates(app)
+    response_cache.maxsize = app.config.get("RESPONSE_CACHE_SIZE", response_cache.maxsize)
+    app.ctx.response_cache = response_cache
+    metrics = setup_metrics(app) if getattr(import_module("app.registry"), "METRICS", False) else None
 
     # setup_logging(app)
     # setup_pagination(app)
     # setup_auth(app)
     setup_middleware(app)
-    setup_blueprints(app)
+    setup_thread_pool(app)
+    setup_blueprints(app, metrics)
+    setup_hot_reload(app)
     # setup_csrf(app)
 
     return app
@@ -0,0 +1,329 @@
+import posixpath
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable
+
+from jinja2 import BaseLoader, Environment, TemplateNotFound, TemplateSyntaxError, meta
+from rich import print
+from rich.markup import escape
+
+# Written next to server.py: for each template, the templates it includes,
+# imports or extends
+TEMPLATE_DEPS = "template_deps.json"
+
+# Comments and raw blocks are skipped. Only tags that load another template are captured
+_TAG = re.compile(
+    r"\{#.*?#\}"
+    r"|\{%[-+]?\s*raw\s*[-+]?%\}.*?\{%[-+]?\s*endraw\s*[-+]?%\}"
+    r"|(\{%[-+]?\s*(?:include|import|from|extends)\b.*?%\})",
+    re.DOTALL,
+)
+_STRING = re.compile(r"""(["'])(.*?)\1""")
+
+
+def resolve_template_paths(source: str, name: str) -> tuple[str, list[str]]:
+    """Rewrite `./` and `../` paths in include, import and extends tags to full template names
+
+    `name` is where the template is written, relative to the templates
+    directory, and relative paths are resolved from its directory. Returns the
+    rewritten source and the names of every template the tags refer to, in
+    order. Names built at runtime (from variables) aren't known here and are
+    left out.
+    """
+    base = posixpath.dirname(name)
+    references = []
+
+    def resolve(match):
+        quote, path = match.groups()
+        if path.startswith(("./", "../")):
+            resolved = posixpath.normpath(posixpath.join(base, path))
+            if resolved.startswith("../"):
+                print(f"[red]{escape(path)} in {escape(name)} is outside the templates")
+                return match.group()
+            path = resolved
+        references.append(path)
+        return f"{quote}{path}{quote}"
+
+    def rewrite(match):
+        if match.group(1) is None:
+            return match.group()
+        return _STRING.sub(resolve, match.group(1))
+
+    return _TAG.sub(rewrite, source), references
+
+
+@lru_cache(maxsize=256)
+def _analyse(source: str) -> tuple[frozenset, tuple]:
+    ast = _jinja_env.parse(source)
+    return frozenset(meta.find_undeclared_variables(ast)), tuple(meta.find_referenced_templates(ast))
+
+
+def template_variables(source: str, load: Callable[[str], str]) -> set[str] | None:
+    """The variables a template, and every template it extends, includes or imports, read from the context
+
+    `load` returns the source of a template by name. Returns None when that
+    can't be known at build time: a template is named by a variable, or
+    can't be loaded or parsed.
+    """
+    names: set[str] = set()
+    seen = set()
+    pending = [source]
+    while pending:
+        try:
+            undeclared, references = _analyse(pending.pop())
+        except TemplateSyntaxError:
+            return None
+        names |= undeclared
+        for name in references:
+            if name is None:
+                return None
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                pending.append(load(name))
+            except TemplateNotFound:
+                return None
+    return names
+
+
+_BLOCKS = re.compile(
+    r"\{#.*?#\}"
+    r"|\{%[-+]?\s*raw\s*[-+]?%\}.*?\{%[-+]?\s*endraw\s*[-+]?%\}"
+    r"|(?P<open>\{%(?P<open_left>[-+]?)\s*block\s+(?P<name>\w+)(?P<modifiers>(?:\s+(?:scoped|required))*)\s*"
+    r"(?P<open_right>[-+]?)%\})"
+    r"|(?P<end>\{%(?P<end_left>[-+]?)\s*endblock(?:\s+\w+)?\s*(?P<end_right>[-+]?)%\})",
+    re.DOTALL,
+)
+_EXTENDS = re.compile(r"""\{%[-+]?\s*extends\s+(["'])([^"']+)\1\s*[-+]?%\}""")
+_COMMENT = re.compile(r"\{#.*?#\}", re.DOTALL)
+_SUPER = re.compile(r"\bsuper\s*\(")
+# Only plain includes of a literal name are inlined: no lists, `ignore missing`,
+# context modifiers or whitespace control
+_INCLUDE = re.compile(
+    r"\{#.*?#\}"
+    r"|\{%[-+]?\s*raw\s*[-+]?%\}.*?\{%[-+]?\s*endraw\s*[-+]?%\}"
+    r"""|\{%\s*include\s+(["'])([^"']+)\1\s*%\}""",
+    re.DOTALL,
+)
+# Statements whose effects would leak into the including template if inlined
+_SCOPED = re.compile(r"\{%[-+]?\s*(?:set|macro|import|from|extends|block|call)\b")
+# How deep included templates are inlined into each other
+MAX_INCLUDE_DEPTH = 8
+
+# Jinja tags, and the HTML whose whitespace matters (`<pre>`, `<textarea>`,
+# `<script>`, `<style>` and quoted attribute values), are kept as they are
+_MINIFY = re.compile(
+    r"(?P<keep>\{#.*?#\}"
+    r"|\{%[-+]?\s*raw\s*[-+]?%\}.*?\{%[-+]?\s*endraw\s*[-+]?%\}"
+    r"|\{%.*?%\}|\{\{.*?\}\}"
+    r"|<(?P<verbatim>pre|textarea|script|style)\b.*?</(?P=verbatim)\s*>"
+    r"""|=\s*"[^"]*"|=\s*'[^']*')"""
+    r"|(?P<comment><!--.*?-->)"
+    r"|\s+",
+    re.DOTALL | re.IGNORECASE,
+)
+_JINJA = re.compile(r"\{[{%#]")
+MINIFIED_SUFFIXES = (".html", ".htm")
+
+_jinja_env = Environment()
+
+
+@dataclass
+class Block:
+    """A `{% block %}` of a template, with the whitespace control of its tags"""
+
+    name: str
+    modifiers: str
+    open_left: str
+    open_right: str
+    body: list = field(default_factory=list)
+    end_left: str = ""
+    end_right: str = ""
+
+
+def parse_blocks(source: str) -> list | None:
+    """Split a template into text and `Block`s, or None if its block tags don't pair up"""
+    root: list = []
+    stack = [(None, root)]
+    pos = 0
+    for match in _BLOCKS.finditer(source):
+        if not (match.group("open") or match.group("end")):
+            continue
+        stack[-1][1].append(source[pos : match.start()])
+        pos = match.end()
+        if match.group("open"):
+            block = Block(*match.group("name", "modifiers", "open_left", "open_right"))
+            stack[-1][1].append(block)
+            stack.append((block, block.body))
+        else:
+            if len(stack) == 1:
+                return None
+            block, _ = stack.pop()
+            block.end_left, block.end_right = match.group("end_left", "end_right")
+    if len(stack) != 1:
+        return None
+    root.append(source[pos:])
+    return root
+
+
+def _walk(items):
+    for item in items:
+        if isinstance(item, Block):
+            yield item
+            yield from _walk(item.body)
+
+
+def flatten_template(name: str, load: Callable[[str], str]) -> str | None:
+    """Inline the layouts a template extends and the templates it includes into one template
+
+    `load` returns the source of a template by name. The result renders the
+    same as the chain: the root template with every block replaced by its
+    most derived definition. Block tags are kept, so each block can still be
+    rendered on its own as a fragment. Returns None for templates that can't
+    be flattened this way: ones that call `super()`, have anything but blocks
+    after their `extends`, or extend a name only known at runtime.
+    """
+    suffix = posixpath.splitext(name)[1]
+    chain = []
+    seen = set()
+    while name is not None:
+        if name in seen:
+            return None
+        seen.add(name)
+        try:
+            source = load(name)
+        except TemplateNotFound:
+            return None
+        if _SUPER.search(source) or (tree := parse_blocks(source)) is None:
+            return None
+        outside = _COMMENT.sub("", "".join(item for item in tree if isinstance(item, str)))
+        if (extends := _EXTENDS.search(outside)) is not None:
+            if outside.replace(extends.group(), "", 1).strip():
+                return None
+            name = extends.group(2)
+        elif "extends" in outside:
+            return None
+        else:
+            name = None
+        chain.append(tree)
+
+    definitions = {}
+    for tree in reversed(chain):
+        for block in _walk(tree):
+            definitions[block.name] = block
+
+    placed = set()
+
+    def emit(items, out):
+        for item in items:
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            definer = definitions[item.name]
+            placed.add(item.name)
+            modifiers = item.modifiers if definer is item else item.modifiers.replace(" required", "")
+            out.append(f"{{%{item.open_left} block {item.name}{modifiers} {definer.open_right}%}}")
+            emit(definer.body, out)
+            out.append(f"{{%{definer.end_left} endblock {item.end_right}%}}")
+
+    out: list = []
+    emit(chain[-1], out)
+    # Blocks the chain never renders can still be rendered as fragments. They
+    # go first, so the root keeps its trailing newline handling
+    unplaced: list = []
+    for block_name, block in definitions.items():
+        if block_name not in placed:
+            unplaced.append("{% if false %}")
+            emit([block], unplaced)
+            unplaced.append("{% endif %}")
+    return inline_includes("".join(unplaced + out), suffix, load)
+
+
+def inline_includes(source: str, suffix: str, load: Callable[[str], str], depth: int = 0) -> str:
+    """Replace plain includes of templates that don't set anything with their source"""
+    if depth >= MAX_INCLUDE_DEPTH:
+        return source
+
+    def inline(match):
+        if (included := match.group(2)) is None:
+            return match.group()
+        if posixpath.splitext(included)[1] != suffix:
+            # Autoescaping could differ
+            return match.group()
+        try:
+            text = load(included)
+        except TemplateNotFound:
+            return match.group()
+        if _SCOPED.search(text):
+            return match.group()
+        # As Jinja drops a single trailing newline when loading a template
+        text = text[:-1] if text.endswith("\n") else text
+        return inline_includes(text, suffix, load, depth + 1)
+
+    return _INCLUDE.sub(inline, source)
+
+
+def minify_html(source: str) -> str:
+    """Collapse the whitespace and drop the comments of an HTML template
+
+    Each run of whitespace becomes a single newline, or a single space if it
+    has no newline, so text reads the same in the browser. HTML comments are
+    dropped unless they are conditional comments or hold Jinja tags, which
+    would still run.
+    """
+
+    def minify(match):
+        if match.group("keep") is not None:
+            return match.group()
+        if (comment := match.group("comment")) is not None:
+            return comment if comment.startswith("<!--[if") or _JINJA.search(comment) else ""
+        return "\n" if "\n" in match.group() else " "
+
+    return _MINIFY.sub(minify, source)
+
+
+class FlatteningLoader(BaseLoader):
+    """Loads the given page templates flattened, and every other template as `loader` does
+
+    The flattened sources are kept in `flattened`, keyed by template name.
+    """
+
+    def __init__(self, loader: BaseLoader, pages: set[str]):
+        self.loader = loader
+        self.pages = pages
+        self.flattened: dict[str, str] = {}
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = self.loader.get_source(environment, template)
+        if template in self.pages:
+            flat = flatten_template(template, lambda name: self.loader.get_source(environment, name)[0])
+            if flat is not None:
+                self.flattened[template] = source = flat
+        return source, filename, uptodate
+
+
+class MinifyingLoader(BaseLoader):
+    """Loads HTML templates minified with `minify_html`, and others as `loader` does
+
+    The size of each minified template, before and after, is kept in `sizes`.
+    """
+
+    def __init__(self, loader: BaseLoader):
+        self.loader = loader
+        self.sizes: dict[str, tuple[int, int]] = {}
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = self.loader.get_source(environment, template)
+        if posixpath.splitext(template)[1] in MINIFIED_SUFFIXES:
+            minified = minify_html(source)
+            self.sizes[template] = (len(source.encode()), len(minified.encode()))
+            source = minified
+        return source, filename, uptodate
@@ -0,0 +1,115 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Callable, Collection
+from urllib.parse import urlsplit
+
+import httpx
+
+from .manifest import hash_bytes
+
+UNPKG = "https://unpkg.com/"
+# Under build/app/static. Files in here already carry a content hash in their name
+VENDOR = "vendor"
+VENDOR_CACHE = Path(".sanickit") / "vendor"
+VENDOR_LOCK = Path(".sanickit") / "vendor.json"
+
+# Takes a URL and returns the URL it finally resolved to (after redirects) and the content
+Fetcher = Callable[[str], tuple[str, bytes]]
+
+
+class VendorError(Exception):
+    """Raised when a vendored file can't be fetched or no longer matches its lock"""
+
+
+def http_fetch(url: str) -> tuple[str, bytes]:
+    try:
+        response = httpx.get(url, follow_redirects=True, timeout=30)
+        response.raise_for_status()
+    except httpx.HTTPError as error:
+        msg = f"Couldn't fetch {url}: {error}"
+        raise VendorError(msg) from error
+    return str(response.url), response.content
+
+
+def vendored_name(url: str, digest: str) -> str:
+    """`https://unpkg.com/htmx.org@1.9.2/dist/htmx.min.js` becomes `htmx.<digest>.min.js`"""
+    name = urlsplit(url).path.rstrip("/").rpartition("/")[2] or "index"
+    stem, dot, suffix = name.partition(".")
+    return f"{stem}.{digest[:12]}{dot}{suffix}"
+
+
+def is_vendored(path: Path, cache: Path = VENDOR_CACHE) -> bool:
+    """Whether `path` is a copy `vendor_urls` made: named after its content's hash, and that content is in `cache`"""
+    if not path.is_file():
+        return False
+    digest = hash_bytes(path.read_bytes())
+    return path.name.partition(".")[2].partition(".")[0] == digest[:12] and (cache / digest).exists()
+
+
+def remove_vendored(vendor: Path, keep: Collection[str] = (), cache: Path = VENDOR_CACHE):
+    """Delete the copies `vendor_urls` made in `vendor`, other than `keep`
+
+    The project's own `static/vendor/` is copied into the same place, so
+    anything else there is left alone.
+    """
+    if not vendor.is_dir():
+        return
+    for path in vendor.iterdir():
+        if path.name not in keep and is_vendored(path, cache):
+            path.unlink()
+    if not any(vendor.iterdir()):
+        vendor.rmdir()
+
+
+def vendor_urls(
+    urls: list[str],
+    static: Path,
+    fetcher: Fetcher = http_fetch,
+    cache: Path = VENDOR_CACHE,
+    lock_path: Path = VENDOR_LOCK,
+) -> dict[str, str]:
+    """Copy remote scripts and stylesheets into `static/vendor/`
+
+    The first fetch of a URL pins it: the lock file records what it resolved
+    to (unpkg redirects a bare package name to a versioned file) and the hash
+    of the content, and the content is kept in `cache`. Later builds use the
+    cache and never touch the network, so the cache and lock can be committed
+    for air-gapped builds. A pinned file that has gone from the cache is
+    fetched again from the resolved URL and must still match its hash.
+
+    Returns a mapping of each URL to its local `/static/vendor/...` URL.
+    """
+    try:
+        lock = json.loads(lock_path.read_text())
+    except (OSError, ValueError):
+        lock = {}
+
+    vendor = static / VENDOR
+    vendor.mkdir(exist_ok=True, parents=True)
+    cache.mkdir(exist_ok=True, parents=True)
+
+    local = {}
+    for url in urls:
+        pinned = lock.get(url)
+        if pinned and (cache / pinned["hash"]).exists():
+            resolved, digest = pinned["resolved"], pinned["hash"]
+        else:
+            resolved, data = fetcher(pinned["resolved"] if pinned else url)
+            digest = hash_bytes(data)
+            if pinned and digest != pinned["hash"]:
+                msg = f"{resolved} has changed since it was vendored. Remove it from {lock_path} to update it."
+                raise VendorError(msg)
+            (cache / digest).write_bytes(data)
+            lock[url] = {"resolved": resolved, "hash": digest}
+
+        name = vendored_name(resolved, digest)
+        if not (vendor / name).exists():
+            shutil.copyfile(cache / digest, vendor / name)
+        local[url] = f"/static/{VENDOR}/{name}"
+
+    remove_vendored(vendor, {url.rpartition("/")[2] for url in local.values()}, cache)
+
+    lock_path.parent.mkdir(exist_ok=True, parents=True)
+    lock_path.write_text(json.dumps({url: lock[url] for url in sorted(local)}, indent=1))
+    return local
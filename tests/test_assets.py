@@ -0,0 +1,61 @@
+import gzip
+import json
+
+from sanickit.assets import MIN_COMPRESS_SIZE, fingerprint_static, fingerprinted_name, rewrite_static_urls
+from sanickit.manifest import hash_bytes
+
+CSS = b"body { margin: 0 }\n" * 32
+
+
+def test_fingerprinted_names_keep_the_directory_and_every_suffix():
+    assert fingerprinted_name("css/app.css", "0123456789abcdef") == "css/app.0123456789ab.css"
+    assert fingerprinted_name("app.min.js", "0123456789abcdef") == "app.0123456789ab.min.js"
+
+
+def test_static_files_get_hashed_and_compressed_copies(tmp_path):
+    static, manifest = tmp_path / "static", tmp_path / "static.json"
+    (static / "css").mkdir(parents=True)
+    (static / "css" / "app.css").write_bytes(CSS)
+    (static / "logo.png").write_bytes(b"\x89PNG" * MIN_COMPRESS_SIZE)
+    (static / "vendor.abc.js").write_bytes(b"let x = 1;\n" * 64)
+
+    files = fingerprint_static(static, manifest, already_hashed={"vendor.abc.js"})
+    hashed = fingerprinted_name("css/app.css", hash_bytes(CSS))
+    assert files == {
+        "css/app.css": hashed,
+        "logo.png": fingerprinted_name("logo.png", hash_bytes((static / "logo.png").read_bytes())),
+        "vendor.abc.js": "vendor.abc.js",
+    }
+    assert (static / hashed).read_bytes() == CSS
+    assert gzip.decompress((static / f"{hashed}.gz").read_bytes()) == CSS
+    # The original is compressed too, for references that aren't rewritten
+    assert (static / "css" / "app.css.gz").exists()
+    assert (static / "vendor.abc.js.gz").exists()
+    assert not (static / f"{files['logo.png']}.gz").exists()
+    assert json.loads(manifest.read_text())["files"] == files
+
+
+def test_outputs_that_are_no_longer_needed_are_removed(tmp_path):
+    static, manifest = tmp_path / "static", tmp_path / "static.json"
+    static.mkdir()
+    (static / "app.css").write_bytes(CSS)
+    old = fingerprint_static(static, manifest)["app.css"]
+
+    (static / "app.css").write_bytes(CSS + b"p { color: red }\n")
+    new = fingerprint_static(static, manifest)["app.css"]
+    assert new != old
+    assert not (static / old).exists()
+    assert not (static / f"{old}.gz").exists()
+    assert (static / new).exists()
+
+
+def test_static_urls_are_rewritten_to_the_hashed_files():
+    files = {"css/app.css": "css/app.0123456789ab.css"}
+    source = (
+        '<link href="/static/css/app.css"><link href="/static/css/app.css?v=2">'
+        "<div style=\"background: url(/static/css/app.css)\"></div><img src='/static/missing.png'>"
+    )
+    assert rewrite_static_urls(source, files) == (
+        '<link href="/static/css/app.0123456789ab.css"><link href="/static/css/app.0123456789ab.css?v=2">'
+        "<div style=\"background: url(/static/css/app.0123456789ab.css)\"></div><img src='/static/missing.png'>"
+    )
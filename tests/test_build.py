@@ -0,0 +1,134 @@
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+from sanic import Sanic
+
+from sanickit.cli import _build
+
+TEMPLATE = Path(__file__).parent.parent / "src" / "sanickit" / "template" / "default"
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """The default project with pages at /a and /b, built once"""
+    shutil.copytree(TEMPLATE, tmp_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns("*.jinja", "__pycache__"))
+    for name in ("a", "b"):
+        write(tmp_path / "src" / "routes" / name / "+page.sanic", f"{{% block main %}}<p>{name}</p>{{% endblock %}}\n")
+    monkeypatch.chdir(tmp_path)
+    _build(quiet=True)
+    return tmp_path
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def built(name):
+    return (Path("build") / "templates" / name).read_text()
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Makes the built app, to send requests to with its test client"""
+    monkeypatch.syspath_prepend("build")
+    monkeypatch.setattr(Sanic, "test_mode", True)
+    monkeypatch.setattr(Sanic, "_app_registry", {})
+    yield lambda: __import__("app.server").server.create_app(None)
+    for module in [name for name in sys.modules if name == "app" or name.startswith("app.")]:
+        del sys.modules[module]
+
+
+def test_an_unchanged_build_does_nothing(project):
+    report = _build(quiet=True)
+    assert (report.modules, report.templates, report.restart) == ([], [], False)
+
+
+def test_an_edit_rebuilds_only_that_page(project):
+    write(Path("src/routes/a/+page.sanic"), "{% block main %}<p>edited</p>{% endblock %}\n")
+    report = _build(quiet=True, changes={"src/routes/a/+page.sanic"})
+    assert report.templates == ["routes/a/+page.html"]
+    assert "edited" in built("routes/a/+page.html")
+
+
+def test_a_deleted_page_is_removed(project):
+    shutil.rmtree("src/routes/b")
+    report = _build(quiet=True, changes={"src/routes/b/+page.sanic"})
+    assert report.restart
+    assert not (Path("build") / "templates" / "routes" / "b" / "+page.html").exists()
+    assert "routes/b" not in (Path("build") / "app" / "registry.py").read_text()
+
+
+def test_a_layout_change_rebuilds_the_pages_under_it(project):
+    write(Path("src/routes/a/+layout.html"), "<div>{% block main %}{% endblock %}</div>\n")
+    report = _build(quiet=True, changes={"src/routes/a/+layout.html"})
+    assert "routes/a/+layout.html" in report.templates
+    assert "routes/a/+page.html" in report.templates
+    assert built("routes/a/+page.html").startswith('{% extends "routes/a/+layout.html" %}')
+
+
+def test_a_failed_build_leaves_nothing_stale_behind(project):
+    page_a, page_b = Path("src/routes/a/+page.sanic"), Path("src/routes/b/+page.sanic")
+    original_a, original_b = page_a.read_text(), page_b.read_text()
+    # So both slots have a manifest
+    _build(quiet=True)
+
+    # a is written into the slot before b stops the build
+    page_a.write_text("{% block main %}<p>edited</p>{% endblock %}\n")
+    page_b.write_text("<handler>\n" + original_b)
+    with pytest.raises(SystemExit):
+        _build(quiet=True, changes={page_a.as_posix(), page_b.as_posix()})
+    # The server keeps the last good build
+    assert "edited" not in built("routes/a/+page.html")
+
+    page_a.write_text(original_a)
+    page_b.write_text(original_b)
+    _build(quiet=True, changes={page_a.as_posix(), page_b.as_posix()})
+    assert "edited" not in built("routes/a/+page.html")
+    assert "<p>b</p>" in built("routes/b/+page.html")
+
+
+def test_a_json_api_route_still_returns_json_errors(project, serve):
+    write(
+        Path("src/routes/api/+server.py"),
+        "from sanic.response import json\n\n"
+        "async def get(request):\n"
+        "    if request.args.get('fail'):\n"
+        "        raise ValueError('broken')\n"
+        "    return json({'ok': True})\n",
+    )
+    _build(quiet=True)
+    app = serve()
+
+    _, response = app.test_client.get("/api")
+    assert response.json == {"ok": True}
+    _, response = app.test_client.get("/api", params={"fail": 1})
+    assert response.status == 500
+    assert response.content_type == "application/json"
+
+
+@pytest.mark.parametrize(
+    ("path", "text", "restart"),
+    [
+        ("src/routes/a/+page.sanic", "{% block main %}<p>new</p>{% endblock %}\n", False),
+        ("src/routes/a/+page.sanic", "<handler>\nx = 1\n</handler>\n{% block main %}{{ x }}{% endblock %}\n", False),
+        ("src/routes/a/+layout.html", "<div>{% block main %}{% endblock %}</div>\n", False),
+        ("src/routes/c/+page.sanic", "{% block main %}<p>c</p>{% endblock %}\n", True),
+        ("src/routes/api/+server.py", "async def get(request): ...\n", True),
+        ("src/lib/helpers.py", "X = 1\n", True),
+        ("src/middleware/headers.py", "X = 1\n", True),
+    ],
+)
+def test_what_the_running_server_restarts_for(project, path, text, restart):
+    write(Path(path), text)
+    assert _build(quiet=True, changes={path}).restart is restart
+
+
+def test_a_handler_edit_is_hot_reloaded(project):
+    write(Path("src/routes/api/+server.py"), "async def get(request): ...\n")
+    _build(quiet=True)
+    write(Path("src/routes/api/+server.py"), "async def get(request):\n    return 1\n")
+    report = _build(quiet=True, changes={"src/routes/api/+server.py"})
+    assert (report.modules, report.templates, report.restart) == (["app.handlers.api"], [], False)
@@ -0,0 +1,61 @@
+from pathlib import Path
+
+from sanickit.cli import current_slot, drop_shadowed_fragments, print_minified, publish_slot, staging_slot
+
+
+def test_pages_win_over_fragment_routes_with_their_url():
+    index = ("/", "GET", "index", "app.handlers.index", "index", None, "html", None)
+    main_block = ("/main", "GET", "index-main", "app.handlers.index", "index", ("routes/+page.html", "main"), "", None)
+    side_block = ("/side", "GET", "index-side", "app.handlers.index", "index", ("routes/+page.html", "side"), "", None)
+    main_page = ("main", "GET", "main", "app.handlers.main", "main", None, "html", None)
+    post = ("side", "POST", "side_post", "app.handlers.side", "side_post", None, "", None)
+
+    assert drop_shadowed_fragments([index, main_block, side_block, main_page, post]) == [
+        index,
+        side_block,
+        main_page,
+        post,
+    ]
+
+
+def make_slot(build_root, version):
+    slot = staging_slot(build_root)
+    for name in ("app", "templates"):
+        (slot / name).mkdir(parents=True, exist_ok=True)
+        (slot / name / "version.txt").write_text(version)
+    return slot
+
+
+def test_slots_are_copied_into_place_where_symlinks_cant_be_made(tmp_path, monkeypatch):
+    def no_symlinks(*args, **kwargs):
+        raise OSError("A required privilege is not held by the client")
+
+    monkeypatch.setattr(Path, "symlink_to", no_symlinks)
+    first = make_slot(tmp_path, "1")
+    publish_slot(tmp_path, first)
+    second = make_slot(tmp_path, "2")
+    assert second != first
+    publish_slot(tmp_path, second)
+
+    assert current_slot(tmp_path) == second
+    assert not (tmp_path / "app").is_symlink()
+    assert (tmp_path / "app" / "version.txt").read_text() == "2"
+    assert (tmp_path / "templates" / "version.txt").read_text() == "2"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["app", "current", "slots", "templates"]
+
+    monkeypatch.undo()
+    third = make_slot(tmp_path, "3")
+    publish_slot(tmp_path, third)
+    assert current_slot(tmp_path) == third
+    assert (tmp_path / "app").is_symlink()
+    assert (tmp_path / "app" / "version.txt").read_text() == "3"
+
+
+def test_the_minify_report_shows_every_template(capsys):
+    sizes = {f"routes/{number}/+page.html": (1000, 1000 - number) for number in range(12)}
+    sizes["empty.html"] = (0, 0)
+    print_minified(sizes)
+    out = capsys.readouterr().out
+    assert all(name in out for name in sizes)
+    assert out.index("routes/11/+page.html") < out.index("routes/1/+page.html")
+    assert "from 12000 to 11934 bytes" in out
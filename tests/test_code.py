@@ -0,0 +1,258 @@
+import ast
+from textwrap import dedent
+
+import pytest
+
+from sanickit.code import HandlerError, LocalNames, bound_at_returns, extract_api, extract_imports
+
+
+def api(tmp_path, source):
+    path = tmp_path / "+server.py"
+    path.write_text(dedent(source))
+    return extract_api(path, "items", "routes/items/+server.html", [])
+
+
+def test_methods_are_handlers_and_other_functions_helpers(tmp_path):
+    imports, handlers, helpers = api(
+        tmp_path,
+        """\
+        from sanic.response import json
+
+        def _shape(x):
+            return {"x": x}
+
+        async def get(request):
+            return json(_shape(1))
+
+        @concurrency(2)
+        def POST(request):
+            return json(_shape(2))
+        """,
+    )
+    assert imports == {"from sanic.response import json"}
+    assert [(handler.name, handler.method, handler.threads) for handler in handlers] == [
+        ("items_get", "GET", None),
+        ("items_POST", "POST", 2),
+    ]
+    assert helpers == ["def _shape(x):\n    return {'x': x}"]
+    assert handlers[1].code.startswith("def items_POST(request, *, TEMPLATE=")
+
+
+@pytest.mark.parametrize(
+    ("body", "error_format"),
+    [
+        ("return json({})", "json"),
+        ("if x:\n        return text('x')\n    return text('y')", "text"),
+        ("return raw(b'', content_type='text/html')", "html"),
+        ("if x:\n        return json({})\n    return html('')", ""),
+        ("return render()", ""),
+    ],
+)
+def test_handlers_get_the_error_format_of_what_they_return(tmp_path, body, error_format):
+    _, [handler], _ = api(tmp_path, f"async def get(request):\n    {body}\n")
+    assert handler.error_format == error_format
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "async def get(request): ...\ndef GET(request): ...\n",
+        "def items_get(x): ...\nasync def get(request): ...\n",
+        "@concurrency(2)\ndef fetch(request): ...\n",
+        "@concurrency(0)\ndef get(request): ...\n",
+    ],
+)
+def test_ambiguous_functions_fail_the_build(tmp_path, source):
+    with pytest.raises(HandlerError):
+        api(tmp_path, source)
+
+
+def bound_at(source):
+    """The names `bound_at_returns` finds bound at each `return` in `source`, in order, and at its end"""
+    tree = ast.parse(dedent(source))
+    returns = {}
+    end = bound_at_returns(tree.body, set(), returns)
+    nodes = sorted((node for node in ast.walk(tree) if isinstance(node, ast.Return)), key=lambda node: node.lineno)
+    return [returns[id(node)] for node in nodes], end
+
+
+def test_bound_at_returns_in_if_branches():
+    returns, end = bound_at(
+        """\
+        x = 1
+        if (y := f()):
+            z = 2
+            return
+        else:
+            return
+        return
+        """
+    )
+    assert returns == [{"x", "y", "z"}, {"x", "y"}, {"x", "y"}]
+    assert end == {"x", "y"}
+
+
+def test_names_bound_on_both_branches_are_bound_after_the_if():
+    returns, end = bound_at(
+        """\
+        if a:
+            x = y = 1
+        elif b:
+            x = 2
+        else:
+            x = 3
+            z = 4
+        return
+        if c:
+            w = 1
+        return
+        if d:
+            v = 1
+        else:
+            raise ValueError
+        return
+        """
+    )
+    assert returns == [{"x"}, {"x"}, {"x", "v"}]
+    assert end == {"x", "v"}
+
+
+def test_bound_at_returns_in_try():
+    returns, end = bound_at(
+        """\
+        try:
+            a = 1
+            return
+        except ValueError as error:
+            return
+        else:
+            return
+        finally:
+            b = 2
+        return
+        """
+    )
+    assert returns == [{"a"}, {"error"}, {"a"}, set()]
+    assert end == set()
+
+
+def test_bound_at_returns_in_match():
+    returns, _ = bound_at(
+        """\
+        match (subject := f()):
+            case [first, *rest]:
+                return
+            case {"key": value, **others}:
+                return
+            case Point(x=x) as point:
+                return
+        return
+        """
+    )
+    assert returns == [
+        {"subject", "first", "rest"},
+        {"subject", "value", "others"},
+        {"subject", "x", "point"},
+        {"subject"},
+    ]
+
+
+def test_bound_at_returns_in_loops_and_with():
+    returns, end = bound_at(
+        """\
+        for item in (items := f()):
+            return
+        while (more := g()):
+            return
+        with open(path) as (handle, _):
+            return
+        return
+        """
+    )
+    after_with = {"items", "more", "handle", "_"}
+    assert returns == [{"item", "items"}, {"items", "more"}, after_with, after_with]
+    assert end == after_with
+
+
+def test_bound_at_returns_after_del():
+    returns, end = bound_at("a = b = 1\ndel a\nreturn\n")
+    assert returns == [{"b"}]
+    assert end == {"b"}
+
+
+def test_local_names_leave_out_nested_scopes_and_globals():
+    local_names = LocalNames()
+    local_names.visit(
+        ast.parse(
+            dedent(
+                """\
+                global counter
+                counter = 1
+                a, (b, *c) = f()
+                squares = [n * n for n in range(3) if (last := n)]
+                handler = lambda event: event
+                def helper(argument):
+                    inner = argument
+                class Row:
+                    field = 1
+                try:
+                    pass
+                except ValueError as error:
+                    pass
+                """
+            )
+        )
+    )
+    assert local_names.outer == {"counter"}
+    assert local_names.names - local_names.outer == {
+        "a",
+        "b",
+        "c",
+        "squares",
+        "last",
+        "handler",
+        "helper",
+        "Row",
+        "error",
+    }
+
+
+def page(code, context):
+    return extract_imports(dedent(code), "items", "routes/items/+page.html", ["id"], context=context)[1]
+
+
+def test_templates_are_passed_only_the_variables_they_read():
+    code = page(
+        """\
+        global site
+        rows = load(id)
+        unused = 1
+        """,
+        {"rows", "id", "site", "title"},
+    )
+    assert "context={'id': id, 'rows': rows}" in code
+    assert "locals()" not in code
+
+
+def test_each_return_passes_the_variables_bound_there():
+    code = page(
+        """\
+        if request.args:
+            rows = load(id)
+            return template()
+        return fragment("main")
+        """,
+        {"rows"},
+    )
+    assert "render('routes/items/+page.html', context={'rows': rows})" in code
+    assert "Fragment.get('routes/items/+page.html', 'main').render(request.app.ext.environment, locals())" in code
+
+
+def test_locals_are_passed_when_a_variable_might_be_unbound(capsys):
+    code = page("if request.args:\n    rows = load(id)\n", {"rows"})
+    assert "context=locals()" in code
+    assert "rows might not be assigned" in capsys.readouterr().out
+
+
+def test_locals_are_passed_when_the_template_reads_are_unknown():
+    assert "context=locals()" in page("rows = load(id)\n", None)
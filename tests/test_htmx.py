@@ -0,0 +1,61 @@
+from importlib.util import module_from_spec, spec_from_file_location
+from pathlib import Path
+
+import pytest
+from sanic import Sanic
+from sanic.compat import Header
+
+TEMPLATE = Path(__file__).parent.parent / "src" / "sanickit" / "template" / "default"
+MIDDLEWARE = TEMPLATE / "src" / "middleware" / "htmx.py"
+
+
+@pytest.fixture(scope="module")
+def htmx():
+    """The template's htmx middleware, which expects the app to exist already"""
+    registry, Sanic._app_registry = Sanic._app_registry, {}
+    Sanic("htmx_test")
+    spec = spec_from_file_location("htmx_middleware", MIDDLEWARE)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    Sanic._app_registry = registry
+
+
+def request(htmx, headers):
+    return htmx.HtmxRequest(b"/items", Header(headers), "1.1", "GET", None, None)
+
+
+def test_details_of_a_plain_request(htmx):
+    plain = request(htmx, [("host", "localhost")])
+    details = plain.ctx.htmx
+    assert not details
+    assert details.request is plain
+    assert (details.target, details.boosted, details.triggering_event) == (None, False, None)
+
+
+def test_details_of_an_htmx_request(htmx):
+    htmx_request = request(
+        htmx,
+        [
+            ("hx-request", "true"),
+            ("hx-boosted", "true"),
+            ("hx-prompt", "caf%C3%A9"),
+            ("hx-prompt-uri-autoencoded", "true"),
+            ("hx-target", "100%"),
+            ("triggering-event", '{"type": "click"}'),
+        ],
+    )
+    details = htmx_request.ctx.htmx
+    assert details
+    assert details.request is htmx_request
+    assert details.boosted
+    assert details.prompt == "café"
+    assert details.target == "100%"
+    assert details.triggering_event == {"type": "click"}
+    assert htmx_request.ctx.htmx is details
+
+
+def test_details_are_read_only(htmx):
+    details = request(htmx, [("hx-request", "true")]).ctx.htmx
+    with pytest.raises(AttributeError):
+        details.request = None
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import re
+from types import SimpleNamespace
+
+import pytest
+from sanic.response import text
+
+from sanickit.template import metrics as metrics_module
+from sanickit.template.metrics import BUCKETS, METRICS_ROUTE, Metrics, count_cache, timing_render
+
+MS = 1_000_000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The metrics' clock, in nanoseconds, which only moves when a test moves it"""
+    now = SimpleNamespace(ns=0)
+    monkeypatch.setattr(metrics_module, "perf_counter_ns", lambda: now.ns)
+    return now
+
+
+def request(metrics, route, clock, handler_ms=1, render_ms=0, status=200, fragment=False, cache=None):
+    """Put a request to `route` through the metrics middleware and a timed handler taking `handler_ms`"""
+
+    async def handler(request):
+        clock.ns += (handler_ms - render_ms) * MS
+        if render_ms:
+            with timing_render(fragment=fragment):
+                clock.ns += render_ms * MS
+        if cache is not None:
+            count_cache(cache)
+        return text("", status=status)
+
+    async def handle():
+        routed = SimpleNamespace(route=SimpleNamespace(name=f"myapp.app_blueprint.{route}"))
+        metrics.begin(routed)
+        response = await metrics.timed(handler, fragment=fragment)(routed)
+        metrics.finish(routed, response)
+
+    asyncio.run(handle())
+
+
+def test_requests_are_counted_and_timed_per_route(clock):
+    metrics = Metrics()
+    request(metrics, "items", clock, handler_ms=2, render_ms=1)
+    request(metrics, "items", clock, handler_ms=30, cache=True)
+    request(metrics, "items-rows", clock, handler_ms=4, render_ms=3, fragment=True, status=404, cache=False)
+
+    items = metrics.routes["items"]
+    assert items.requests == {"page 200": 1, "other 200": 1}
+    assert items.buckets[BUCKETS.index(0.0025)] == 1
+    assert items.buckets[BUCKETS.index(0.05)] == 1
+    assert sum(items.buckets) == 2
+    assert items.latency_ns == 32 * MS
+    assert (items.handler_ns, items.handled) == (31 * MS, 2)
+    assert (items.render_ns, items.renders) == (1 * MS, 1)
+    assert items.cache == [1, 0]
+
+    rows = metrics.routes["items-rows"]
+    assert rows.requests == {"fragment 404": 1}
+    assert (rows.render_ns, rows.renders) == (3 * MS, 1)
+    assert rows.cache == [0, 1]
+
+
+def test_slow_requests_land_in_the_overflow_bucket(clock):
+    metrics = Metrics()
+    request(metrics, "slow", clock, handler_ms=int(BUCKETS[-1] * 1000) + 1)
+    assert metrics.routes["slow"].buckets[-1] == 1
+
+
+def test_the_metrics_route_and_unrouted_requests_are_not_counted(clock):
+    metrics = Metrics()
+    request(metrics, METRICS_ROUTE, clock)
+    metrics.begin(SimpleNamespace(route=None))
+    metrics.finish(SimpleNamespace(route=None), SimpleNamespace(status=404))
+    assert metrics.routes == {}
+
+
+def test_other_workers_snapshots_are_merged(tmp_path, clock):
+    this, other = Metrics(), Metrics()
+    request(this, "items", clock, handler_ms=2)
+    request(other, "items", clock, handler_ms=20, status=500)
+    request(other, "about", clock, handler_ms=1)
+    this.directory = other.directory = tmp_path
+    (tmp_path / "1.json").write_text(json.dumps(other.snapshot()))
+    # This worker's own snapshot is older than its live counts, and a partly written one is skipped
+    (tmp_path / f"{os.getpid()}.json").write_text(json.dumps(other.snapshot()))
+    (tmp_path / "2.json").write_text('{"items": ')
+
+    merged = this.collect()
+    assert sorted(merged) == ["about", "items"]
+    assert merged["items"].requests == {"other 200": 1, "other 500": 1}
+    assert merged["items"].latency_ns == 22 * MS
+    assert merged["about"].requests == {"other 200": 1}
+
+
+def test_a_flushed_snapshot_is_what_the_others_read(tmp_path, clock):
+    metrics = Metrics()
+    metrics.directory = tmp_path
+    request(metrics, "items", clock)
+    metrics.flush()
+    assert json.loads((tmp_path / f"{os.getpid()}.json").read_text()) == metrics.snapshot()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_the_exposition_format(clock):
+    metrics = Metrics()
+    request(metrics, "items", clock, handler_ms=2, render_ms=1, cache=True)
+    request(metrics, 'say "hi"', clock, handler_ms=3000, status=500)
+    lines = metrics.exposition().splitlines()
+
+    assert 'sanickit_requests_total{route="items",kind="page",status="200"} 1' in lines
+    assert 'sanickit_requests_total{route="say \\"hi\\"",kind="other",status="500"} 1' in lines
+    buckets = [line for line in lines if line.startswith('sanickit_request_duration_seconds_bucket{route="items"')]
+    assert buckets[0] == 'sanickit_request_duration_seconds_bucket{route="items",le="0.001"} 0'
+    assert buckets[1] == 'sanickit_request_duration_seconds_bucket{route="items",le="0.0025"} 1'
+    assert buckets[-1] == 'sanickit_request_duration_seconds_bucket{route="items",le="+Inf"} 1'
+    assert 'sanickit_request_duration_seconds_sum{route="items"} 0.002' in lines
+    assert 'sanickit_request_duration_seconds_count{route="items"} 1' in lines
+    assert 'sanickit_render_seconds_sum{route="items"} 0.001' in lines
+    assert 'sanickit_response_cache_total{route="items",result="hit"} 1' in lines
+    # Routes with nothing to report for a family are left out of it
+    assert not any(line.startswith("sanickit_thread_queue_seconds_sum") for line in lines)
+
+    families = set()
+    for line in lines:
+        if line.startswith("# TYPE "):
+            families.add(line.split()[2])
+        elif not line.startswith("# HELP "):
+            assert re.fullmatch(r'(sanickit_\w+)\{(\w+="(?:[^"\\]|\\.)*",?)+\} [\d.e+-]+', line)
+            assert re.sub(r"_(bucket|sum|count)$", "", line.partition("{")[0]) in families
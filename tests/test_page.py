@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import pytest
+
+from sanickit.cli import build_route
+from sanickit.page import Page, PageSyntaxError, parse_duration, parse_page
+
+
+def test_a_page_without_a_handler_is_all_template():
+    assert parse_page("<main>{{ title }}</main>\n") == Page(template="<main>{{ title }}</main>\n")
+
+
+def test_the_handler_is_split_out_verbatim():
+    page = parse_page('<h1>Hi</h1>\n<handler cache="5m" Stream id=int>\n  title = "x"\n</handler>\n<p></p>\n')
+    assert page.template == "<h1>Hi</h1>\n\n<p></p>\n"
+    assert page.handler == '\n  title = "x"\n'
+    assert page.attrs == {"cache": "5m", "stream": "", "id": "int"}
+
+
+def test_a_self_closing_handler_has_no_body():
+    page = parse_page("<handler route-name='home' />\n<p></p>")
+    assert page == Page(template="\n<p></p>", handler="", attrs={"route-name": "home"})
+
+
+@pytest.mark.parametrize(
+    "hidden",
+    [
+        "<!-- <handler>x</handler> -->",
+        "{# <handler>x</handler> #}",
+        "{% raw %}<handler>x</handler>{% endraw %}",
+        "<handlers></handlers>",
+    ],
+)
+def test_handler_tags_in_comments_and_raw_blocks_are_ignored(hidden):
+    assert parse_page(hidden) == Page(template=hidden)
+
+
+@pytest.mark.parametrize("source", ["<handler cache='5m'", "<handler>\nx = 1\n", '<handler cache="5m>\n'])
+def test_unterminated_handlers_are_syntax_errors(source):
+    with pytest.raises(PageSyntaxError):
+        parse_page(source)
+
+
+@pytest.mark.parametrize(
+    ("value", "seconds"),
+    [("90", 90), ("1.5", 1.5), ("250ms", 0.25), ("60s", 60), (" 5m ", 300), ("1h", 3600), ("2d", 172800)],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "5x", "-1s", "m", "1 h 2"])
+def test_bad_durations_are_syntax_errors(value):
+    with pytest.raises(PageSyntaxError):
+        parse_duration(value)
+
+
+@pytest.mark.parametrize(
+    "page",
+    [
+        "<handler>\nx = 1\n",
+        '<handler cache="soon">\nx = 1\n</handler>\n',
+        "<handler>\nx = (\n</handler>\n",
+        "{% block main %}{% endblok %}",
+    ],
+)
+def test_page_syntax_errors_stop_the_build_with_a_message(tmp_path, monkeypatch, capsys, page):
+    monkeypatch.chdir(tmp_path)
+    src, templates = Path("src"), Path("templates")
+    route = src / "routes" / "+page.sanic"
+    route.parent.mkdir(parents=True)
+    route.write_text(page)
+    (route.parent / "+layout.html").write_text("{% block main %}{% endblock %}")
+    templates.mkdir()
+
+    with pytest.raises(SystemExit) as exit_info:
+        build_route(src, Path("build"), templates, route, "routes/+page.html", {})
+    assert exit_info.value.code == 1
+    assert "src/routes/+page.sanic" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("handler", ["async def get(request): ...\ndef GET(request): ...\n", "def get(request:\n"])
+def test_handler_errors_stop_the_build_with_a_message(tmp_path, monkeypatch, capsys, handler):
+    monkeypatch.chdir(tmp_path)
+    src, templates = Path("src"), Path("templates")
+    route = src / "routes" / "items" / "+server.py"
+    route.parent.mkdir(parents=True)
+    route.write_text(handler)
+    templates.mkdir()
+
+    with pytest.raises(SystemExit) as exit_info:
+        build_route(src, Path("build"), templates, route, "routes/items/+server.html", {})
+    assert exit_info.value.code == 1
+    assert "src/routes/items/+server.py" in capsys.readouterr().out
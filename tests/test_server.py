@@ -0,0 +1,254 @@
+import asyncio
+import json
+import sys
+from types import ModuleType, SimpleNamespace
+
+import pytest
+from jinja2 import DictLoader, Environment
+from sanic.compat import Header
+from sanic.exceptions import NotFound
+from sanic.response import text
+
+from sanickit.template import server
+from sanickit.template.server import (
+    IMMUTABLE,
+    Fragment,
+    ResponseCache,
+    accepted_encodings,
+    cache_response,
+    hot_reload,
+    response_cache,
+    static_handler,
+    template_dependents,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The cache's clock, which only moves when a test moves it"""
+    now = SimpleNamespace(time=1000.0)
+    monkeypatch.setattr(server, "monotonic", lambda: now.time)
+    return now
+
+
+@pytest.fixture
+def cache(clock):
+    response_cache.clear()
+    response_cache.hits.clear()
+    response_cache.misses.clear()
+    yield response_cache
+    response_cache.clear()
+
+
+def get(query="", **headers):
+    return SimpleNamespace(method="GET", query_string=query, headers=headers)
+
+
+def cached_handler(ttl=60, vary=(), status=200, **response_headers):
+    """A page handler under `cache_response`, answering with how many times it has been run"""
+    calls = []
+
+    async def items(request, **kwargs):
+        calls.append(kwargs)
+        return text(str(len(calls)), status=status, headers=response_headers)
+
+    return cache_response(ttl, vary)(items), calls
+
+
+def run(handler, request, **kwargs):
+    return asyncio.run(handler(request, **kwargs)).body
+
+
+def test_a_repeated_request_is_answered_from_the_cache(cache):
+    handler, calls = cached_handler()
+    assert run(handler, get(), id=1) == b"1"
+    assert run(handler, get(), id=1) == b"1"
+    assert len(calls) == 1
+    assert (cache.hits["items"], cache.misses["items"]) == (1, 1)
+
+
+def test_cached_responses_expire_after_their_ttl(cache, clock):
+    handler, _ = cached_handler(ttl=5)
+    run(handler, get())
+    clock.time += 5
+    assert run(handler, get()) == b"1"
+    clock.time += 0.1
+    assert run(handler, get()) == b"2"
+
+
+def test_the_least_recently_used_response_is_evicted(clock):
+    cache = ResponseCache(maxsize=2)
+    cache.set("a", 60, "A")
+    cache.set("b", 60, "B")
+    assert cache.get("a") == "A"
+    cache.set("c", 60, "C")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("A", None, "C")
+
+
+@pytest.mark.parametrize(
+    ("first", "second", "shared"),
+    [
+        ((get("page=1"), {}), (get("page=2"), {}), False),
+        ((get(), {"fragment": "rows"}), (get(), {"fragment": "main"}), False),
+        ((get(), {"id": 1}), (get(), {"id": 2}), False),
+        ((get(**{"accept-language": "en"}), {}), (get(**{"accept-language": "fr"}), {}), False),
+        ((get(**{"user-agent": "a"}), {}), (get(**{"user-agent": "b"}), {}), True),
+    ],
+)
+def test_responses_are_keyed_on_the_query_params_fragment_and_vary_headers(cache, first, second, shared):
+    handler, _ = cached_handler(vary=["accept-language"])
+    run(handler, first[0], **first[1])
+    assert run(handler, second[0], **second[1]) == (b"1" if shared else b"2")
+
+
+@pytest.mark.parametrize(("status", "headers"), [(404, {}), (302, {}), (200, {"set-cookie": "session=1"})])
+def test_errors_redirects_and_cookies_are_not_cached(cache, status, headers):
+    handler, calls = cached_handler(status=status, **headers)
+    run(handler, get())
+    run(handler, get())
+    assert len(calls) == 2
+
+
+def test_other_methods_skip_the_cache(cache):
+    handler, calls = cached_handler()
+    post = SimpleNamespace(method="POST", query_string="", headers={})
+    run(handler, post)
+    run(handler, post)
+    assert len(calls) == 2
+    assert not cache.misses
+
+
+def test_a_hot_reload_clears_the_cache(cache):
+    handler, _ = cached_handler()
+    run(handler, get())
+    app = SimpleNamespace(ext=SimpleNamespace(templating=SimpleNamespace(environment=Environment())))
+    hot_reload(app, [], [])
+    assert run(handler, get()) == b"2"
+
+
+@pytest.mark.parametrize(
+    ("header", "accepted"),
+    [
+        ("gzip, deflate, br", {"gzip", "deflate", "br"}),
+        ("br;q=0.9, GZIP;q=1.0", {"br", "gzip"}),
+        ("br;q=0, gzip", {"gzip"}),
+        ("gzip;q=0.0, identity", {"identity"}),
+        ("*;q=0.5", {"*"}),
+        ("br;q=high", {"br"}),
+        ("", set()),
+        ("gzip,, ", {"gzip"}),
+    ],
+)
+def test_accepted_encodings(header, accepted):
+    assert accepted_encodings(header) == accepted
+
+
+@pytest.fixture
+def static(tmp_path, monkeypatch):
+    """A production build's static files: app.css, its hashed copy and their gzip and brotli variants"""
+    monkeypatch.setattr(server, "STATIC", tmp_path)
+    for name in ("app.css", "app.0123456789ab.css"):
+        (tmp_path / name).write_text("css")
+        (tmp_path / f"{name}.gz").write_text("gzip")
+        (tmp_path / f"{name}.br").write_text("brotli")
+    (tmp_path / "robots.txt").write_text("robots")
+    return static_handler({"app.0123456789ab.css"})
+
+
+def serve(handler, path, accept_encoding=None):
+    headers = Header({"accept-encoding": accept_encoding} if accept_encoding is not None else {})
+    return asyncio.run(handler(SimpleNamespace(headers=headers), path))
+
+
+@pytest.mark.parametrize(
+    ("accept_encoding", "encoding", "body"),
+    [
+        ("gzip, deflate, br", "br", b"brotli"),
+        ("gzip", "gzip", b"gzip"),
+        ("br;q=0, gzip", "gzip", b"gzip"),
+        ("*", "br", b"brotli"),
+        ("br;q=0, gzip;q=0", None, b"css"),
+        (None, None, b"css"),
+    ],
+)
+def test_the_preferred_accepted_variant_is_sent(static, accept_encoding, encoding, body):
+    response = serve(static, "app.css", accept_encoding)
+    assert response.body == body
+    assert response.headers.get("content-encoding") == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content_type.startswith("text/css")
+
+
+def test_only_fingerprinted_files_are_cached_forever(static):
+    assert serve(static, "app.0123456789ab.css").headers["cache-control"] == IMMUTABLE
+    assert serve(static, "app.css").headers["cache-control"] == "no-cache"
+    response = serve(static, "robots.txt", "gzip")
+    assert response.headers["cache-control"] == "no-cache"
+    assert "vary" not in response.headers
+    assert "content-encoding" not in response.headers
+
+
+@pytest.mark.parametrize("path", ["missing.css", "../outside.css", ""])
+def test_missing_and_outside_files_are_not_found(static, tmp_path, path):
+    (tmp_path.parent / "outside.css").write_text("secret")
+    with pytest.raises(NotFound):
+        serve(static, path)
+
+
+TEMPLATES = {
+    "index.html": "<html>{% block body %}{% endblock %}</html>",
+    "routes/+layout.html": "{% extends 'index.html' %}{% block body %}{% block main %}{% endblock %}{% endblock %}",
+    "routes/+page.html": "{% extends 'routes/+layout.html' %}{% block main %}{% include 'row.html' %}{% endblock %}",
+    "routes/about/+page.html": "{% extends 'index.html' %}{% block body %}about{% endblock %}",
+    "row.html": "<tr></tr>",
+}
+
+
+@pytest.fixture
+def template_deps(tmp_path, monkeypatch):
+    deps = tmp_path / "template_deps.json"
+    deps.write_text(
+        json.dumps(
+            {
+                "routes/+layout.html": ["index.html"],
+                "routes/+page.html": ["routes/+layout.html", "row.html"],
+                "routes/about/+page.html": ["index.html"],
+            }
+        )
+    )
+    monkeypatch.setattr(server, "TEMPLATE_DEPS", deps)
+
+
+@pytest.mark.parametrize(
+    ("changed", "dependents"),
+    [
+        ({"row.html"}, {"row.html", "routes/+page.html"}),
+        ({"routes/+layout.html"}, {"routes/+layout.html", "routes/+page.html"}),
+        ({"index.html"}, {"index.html", "routes/+layout.html", "routes/+page.html", "routes/about/+page.html"}),
+        ({"routes/about/+page.html"}, {"routes/about/+page.html"}),
+        ({"unknown.html"}, {"unknown.html"}),
+    ],
+)
+def test_template_dependents(template_deps, changed, dependents):
+    assert template_dependents(changed) == dependents
+
+
+def test_a_hot_reload_only_drops_what_the_changes_affect(template_deps, monkeypatch, cache):
+    environment = Environment(loader=DictLoader(TEMPLATES))
+    for name in TEMPLATES:
+        environment.get_template(name)
+    page, about = Fragment.get("routes/+page.html", "main"), Fragment.get("routes/about/+page.html", "body")
+    page._render = about._render = object()
+    monkeypatch.setattr(server, "_handlers", {("app.handlers.index", "index_get", None): object()})
+    monkeypatch.setitem(sys.modules, "app.handlers.index", ModuleType("app.handlers.index"))
+    monkeypatch.setitem(sys.modules, "app.handlers.about", ModuleType("app.handlers.about"))
+
+    app = SimpleNamespace(ext=SimpleNamespace(templating=SimpleNamespace(environment=environment)))
+    hot_reload(app, ["app.handlers.index"], ["routes/+layout.html"])
+
+    assert {name for _, name in environment.cache.keys()} == {"index.html", "routes/about/+page.html", "row.html"}
+    assert page._render is None
+    assert about._render is not None
+    assert server._handlers == {}
+    assert "app.handlers.index" not in sys.modules
+    assert "app.handlers.about" in sys.modules
@@ -0,0 +1,207 @@
+import pytest
+from jinja2 import DictLoader, Environment
+
+from sanickit.templates import (
+    MAX_INCLUDE_DEPTH,
+    Block,
+    flatten_template,
+    inline_includes,
+    minify_html,
+    parse_blocks,
+    resolve_template_paths,
+)
+
+
+def loader(templates):
+    """A `load` callable for `templates`, raising TemplateNotFound like the build's loaders"""
+    templates_loader = DictLoader(templates)
+    return lambda name: templates_loader.get_source(None, name)[0]
+
+
+def render(templates, name, block=None, **context):
+    template = Environment(loader=DictLoader(templates)).get_template(name)
+    if block is None:
+        return template.render(**context)
+    return "".join(template.blocks[block](template.new_context(context)))
+
+
+def assert_flattens(templates, name="page.html", **context):
+    """Flatten `name` and check it renders, as a whole and block by block, as the chain does"""
+    flat = flatten_template(name, loader(templates))
+    assert flat is not None
+    assert "extends" not in flat
+    flattened = {**templates, "flat.html": flat}
+    assert render(flattened, "flat.html", **context) == render(templates, name, **context)
+    chain = Environment(loader=DictLoader(templates)).get_template(name)
+    for block in chain.blocks:
+        assert render(flattened, "flat.html", block, **context) == render(templates, name, block, **context)
+    return flat
+
+
+LAYOUTS = {
+    "index.html": "<html>\n{% include 'head.html' %}\n<body>{% block body %}{% endblock %}</body>\n</html>\n",
+    "head.html": "<head><title>{{ title }}</title></head>\n",
+}
+
+
+def test_flattening_keeps_whitespace_control():
+    flat = assert_flattens(
+        {
+            **LAYOUTS,
+            "layout.html": "{% extends 'index.html' %}\n{% block body -%}\n  <main>\n  {%- block main %}{% endblock -%}"
+            "\n  </main>\n{%+ endblock %}\n",
+            "page.html": "{% extends 'layout.html' %}\n{%- block main +%}\n  <p>{{ title }}</p>\n{% endblock %}\n",
+        },
+        title="Items",
+    )
+    assert "<title>{{ title }}</title>" in flat
+
+
+def test_flattening_keeps_required_and_scoped_blocks():
+    flat = assert_flattens(
+        {
+            "layout.html": "<ul>{% for item in items %}{% block row scoped required %}{% endblock %}{% endfor %}</ul>"
+            "{% block footer %}<p>footer</p>{% endblock %}",
+            "page.html": "{% extends 'layout.html' %}{% block row scoped %}<li>{{ item }}</li>{% endblock %}",
+        },
+        items=[1, 2],
+    )
+    assert "required" not in flat
+
+
+def test_blocks_the_chain_never_renders_are_kept_for_fragments():
+    flat = assert_flattens(
+        {
+            "layout.html": "<main>{% block main %}{% endblock %}</main>",
+            "page.html": "{% extends 'layout.html' %}{% block main %}main{% endblock %}"
+            "{% block rows %}<tr>{{ rows }}</tr>{% endblock %}",
+        },
+        rows=3,
+    )
+    assert "{% if false %}{% block rows %}" in flat
+
+
+@pytest.mark.parametrize(
+    "page",
+    [
+        "{% extends 'layout.html' %}{% block main %}{{ super() }} more{% endblock %}",
+        "{% extends 'layout.html' %}{% set x = 1 %}{% block main %}{{ x }}{% endblock %}",
+        "{% extends layout_name %}{% block main %}{% endblock %}",
+        "{% extends 'missing.html' %}",
+        "{% extends 'layout.html' %}{% block main %}",
+    ],
+)
+def test_templates_that_cant_be_flattened(page):
+    templates = {"layout.html": "{% block main %}layout{% endblock %}", "page.html": page}
+    assert flatten_template("page.html", loader(templates)) is None
+
+
+def test_parse_blocks_records_modifiers_and_whitespace_control():
+    tree = parse_blocks("a{%- block main scoped +%}b{% block inner %}{#{% endblock %}#}{% endblock %}c{% endblock -%}d")
+    assert tree[0] == "a"
+    main = tree[1]
+    assert isinstance(main, Block)
+    assert (main.name, main.modifiers, main.open_left, main.open_right) == ("main", " scoped", "-", "+")
+    assert (main.end_left, main.end_right) == ("", "-")
+    assert main.body[0] == "b"
+    assert main.body[1].name == "inner"
+    assert main.body[1].body == ["{#{% endblock %}#}"]
+    assert tree[2] == "d"
+
+
+def test_includes_that_set_nothing_are_inlined():
+    templates = {
+        "row.html": "<td>{{ value }}</td>\n",
+        "macros.html": "{% macro cell() %}{% endmacro %}",
+        "icon.svg": "<svg/>",
+    }
+    source = (
+        "{% include 'row.html' %}{% include 'macros.html' %}{% include 'icon.svg' %}"
+        "{% include 'missing.html' %}{% raw %}{% include 'row.html' %}{% endraw %}"
+    )
+    assert inline_includes(source, ".html", loader(templates)) == (
+        "<td>{{ value }}</td>{% include 'macros.html' %}{% include 'icon.svg' %}"
+        "{% include 'missing.html' %}{% raw %}{% include 'row.html' %}{% endraw %}"
+    )
+
+
+def test_include_inlining_stops_at_the_depth_limit():
+    templates = {"nested.html": "x{% include 'nested.html' %}"}
+    inlined = inline_includes("{% include 'nested.html' %}", ".html", loader(templates))
+    assert inlined == "x" * MAX_INCLUDE_DEPTH + "{% include 'nested.html' %}"
+
+
+def test_minifying_collapses_whitespace_between_tags_and_text():
+    assert minify_html("<ul>\n    <li>one   two</li>\n\n    <li>\tthree</li>\n</ul>\n") == (
+        "<ul>\n<li>one two</li>\n<li> three</li>\n</ul>\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "kept",
+    [
+        "<pre>\n  a\n    b\n</pre>",
+        "<PRE class='x'>  a  </PRE >",
+        "<textarea name=\"notes\">\n  keep  </textarea>",
+        "<script>\n  if (a  <  b) {\n    go();\n  }\n</script>",
+        "<style>\n  p  {  margin: 0  }\n</style>",
+        '<div title="two  spaces\n and a newline"></div>',
+        "<div title='two  spaces'></div>",
+        "<!--[if IE]>\n  <p>old</p>\n<![endif]-->",
+        "<!-- {% if debug %} -->",
+        "<!-- {{ version }} -->",
+        "{% if  a  %}",
+        "{{  value  }}",
+        "{#  comment  #}",
+        "{% raw %}  <!-- raw -->  {% endraw %}",
+    ],
+)
+def test_minifying_keeps_what_whitespace_matters_in(kept):
+    assert minify_html(kept) == kept
+
+
+def test_minifying_drops_plain_comments():
+    assert minify_html("<p>a</p>\n<!-- a\ncomment -->\n<p>b</p>") == "<p>a</p>\n\n<p>b</p>"
+
+
+def test_relative_template_paths_are_resolved_from_the_template():
+    source, references = resolve_template_paths(
+        "{% extends '../+layout.html' %}"
+        '{% include "./row.html" %}'
+        "{%- from '../../lib/macros.html' import cell -%}"
+        "{% import 'forms.html' as forms %}"
+        "{% include [name, './fallback.html'] %}",
+        "routes/items/+page.html",
+    )
+    assert source == (
+        "{% extends 'routes/+layout.html' %}"
+        '{% include "routes/items/row.html" %}'
+        "{%- from 'lib/macros.html' import cell -%}"
+        "{% import 'forms.html' as forms %}"
+        "{% include [name, 'routes/items/fallback.html'] %}"
+    )
+    assert references == [
+        "routes/+layout.html",
+        "routes/items/row.html",
+        "lib/macros.html",
+        "forms.html",
+        "routes/items/fallback.html",
+    ]
+
+
+def test_paths_outside_the_templates_are_left_alone(capsys):
+    source = "{% include '../../secret.html' %}"
+    assert resolve_template_paths(source, "routes/+page.html") == (source, [])
+    assert "outside the templates" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "{% raw %}{% include './row.html' %}{% endraw %}",
+        "{#- {% include './row.html' %} -#}",
+        "<p>{{ './row.html' }}</p>",
+    ],
+)
+def test_only_template_tags_are_resolved(source):
+    assert resolve_template_paths(source, "routes/+page.html") == (source, [])
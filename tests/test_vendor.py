@@ -0,0 +1,25 @@
+from sanickit.manifest import hash_bytes
+from sanickit.vendor import VENDOR, remove_vendored, vendor_urls
+
+
+def fetcher(url):
+    return url, f"content of {url}".encode()
+
+
+def test_only_vendored_copies_are_removed(tmp_path):
+    static, cache = tmp_path / "static", tmp_path / "cache"
+    (static / VENDOR).mkdir(parents=True)
+    own = static / VENDOR / "mine.js"
+    own.write_text("the project's own file")
+    # As `sk build --production` fingerprints it
+    fingerprinted = static / VENDOR / f"mine.{hash_bytes(own.read_bytes())[:12]}.js"
+    fingerprinted.write_text(own.read_text())
+    options = {"static": static, "fetcher": fetcher, "cache": cache, "lock_path": tmp_path / "lock.json"}
+
+    old = vendor_urls(["https://unpkg.com/a.min.js"], **options)["https://unpkg.com/a.min.js"]
+    new = vendor_urls(["https://unpkg.com/b.min.js"], **options)["https://unpkg.com/b.min.js"]
+    assert not (tmp_path / old.removeprefix("/")).exists()
+    assert (tmp_path / new.removeprefix("/")).exists()
+
+    remove_vendored(static / VENDOR, cache=cache)
+    assert sorted(path.name for path in (static / VENDOR).iterdir()) == sorted([own.name, fingerprinted.name])